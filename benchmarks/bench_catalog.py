@@ -0,0 +1,124 @@
+#! /usr/bin/env python3
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare cold-start cost of the pickled Gutenberg catalog and the mapped one.
+
+Each run is a fresh Python process, like a CGI request, which loads the catalog and
+answers one lookup. The report is the median wall time and the peak RSS above an
+empty interpreter.
+
+Usage: bench_catalog.py [gutindex.pkl] [runs]
+
+Without a pickle, a synthetic catalog about the size of GUTINDEX.ALL is used.
+
+The files are prepared in a child process too, because a process started from a big
+parent inherits the parent's peak RSS.
+"""
+
+import os
+import pickle
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import catalog
+
+CHILD = """
+import resource, sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+{body}
+elapsed = time.perf_counter() - start
+print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+EMPTY = "pass"
+
+PICKLE = """
+import pickle
+gutindex = pickle.load(open({path!r}, "rb"))
+found = [work for work in gutindex if "witch" in work[0]]
+"""
+
+CATALOG = """
+import catalog
+gutindex = catalog.Catalog({path!r})
+found = [gutindex.record(i) for posting in gutindex.postings("witch") for i in posting]
+"""
+
+
+def synthetic(count):
+  random.seed(0)
+  words = ["the", "of", "and", "witch", "world", "history", "letters", "voyage", "poems",
+           "king", "daughter", "england", "war", "life", "adventures", "volume", "essays"]
+  names = ["dunsany", "cavendish", "austen", "dickens", "twain", "shelley", "eliot", "wells"]
+  gutindex = {}
+  for n in range(count, 0, -1):
+    title = " ".join(random.choice(words) for _ in range(random.randint(2, 8)))
+    title += " {}".format(n)
+    author = "{} {}".format(random.choice(names), random.choice(names))
+    gutindex[(title, author)] = str(n)
+  return gutindex
+
+
+def run(body, runs):
+  times = []
+  rss = []
+  for _ in range(runs):
+    out = subprocess.check_output([sys.executable, "-c", CHILD.format(root=ROOT, body=body)])
+    elapsed, maxrss = out.split()
+    times.append(float(elapsed))
+    rss.append(int(maxrss))
+  return statistics.median(times), statistics.median(rss)
+
+
+def prepare(tmp, pickle_path):
+  if pickle_path:
+    gutindex = pickle.load(open(pickle_path, "rb"))
+  else:
+    gutindex = synthetic(70000)
+    pickle.dump(gutindex, open(os.path.join(tmp, "gutindex.pkl"), "wb"))
+  catalog.write(os.path.join(tmp, "gutindex.cat"),
+                (book + (ebook_no,) for book, ebook_no in gutindex.items()))
+
+
+def main(argv):
+  if len(argv) > 1 and argv[1] == "--prepare":
+    prepare(argv[2], argv[3])
+    return
+  runs = int(argv[2]) if len(argv) > 2 else 5
+  with tempfile.TemporaryDirectory() as tmp:
+    pickle_path = argv[1] if len(argv) > 1 else ""
+    subprocess.check_call([sys.executable, __file__, "--prepare", tmp, pickle_path])
+    pickle_path = pickle_path or os.path.join(tmp, "gutindex.pkl")
+    catalog_path = os.path.join(tmp, "gutindex.cat")
+
+    _, base_rss = run(EMPTY, runs)
+    print("{:<10} {:>10} {:>12} {:>14}".format("format", "size KB", "load+lookup", "extra RSS KB"))
+    for name, path, body in (("pickle", pickle_path, PICKLE),
+                             ("catalog", catalog_path, CATALOG)):
+      elapsed, rss = run(body.format(path=path), runs)
+      print("{:<10} {:>10} {:>10.1f}ms {:>14}".format(
+        name, os.path.getsize(path) // 1024, elapsed * 1000, rss - base_rss))
+
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1,113 @@
+#! /usr/bin/env python3
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare parsing whole Encore pages with parsing only their search results.
+
+Each saved page in testdata/encore is parsed into a full tree, the way Minuteman
+results used to be read, and then with only the div.searchResult blocks kept, with
+each parser that is installed. Both have to give the same answer. The report is the
+median time per page.
+
+Then a batch of pages is parsed from several threads at once, to compare parsing them
+all in this process with handing the extra ones to encore's process pool.
+
+Usage: bench_encore_parse.py [runs]
+"""
+
+import concurrent.futures
+import glob
+import importlib.util
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import encore
+
+FIXTURES = os.path.join(ROOT, "testdata", "encore", "*.html")
+THREADS = 4
+BATCH = 64
+
+
+def parse_with(html, parser, parse_only):
+  saved = encore.PARSER, encore.RESULTS
+  encore.PARSER, encore.RESULTS = parser, parse_only
+  try:
+    return encore.parse_results(html)
+  finally:
+    encore.PARSER, encore.RESULTS = saved
+
+
+def median_time(fn, runs):
+  times = []
+  for _ in range(runs):
+    start = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - start)
+  return statistics.median(times)
+
+
+def batch_time(pages, inline_parses):
+  saved = encore.INLINE_PARSES
+  encore.INLINE_PARSES = inline_parses
+  try:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=THREADS) as executor:
+      start = time.perf_counter()
+      list(executor.map(encore.parse, pages))
+      return time.perf_counter() - start
+  finally:
+    encore.INLINE_PARSES = saved
+
+
+def main(argv):
+  runs = int(argv[1]) if len(argv) > 1 else 20
+  parsers = ["html.parser"] + (["lxml"] if importlib.util.find_spec("lxml") else [])
+  pages = []
+  print("{:<18} {:>8} {:<12} {:>10} {:>10} {:>8}".format(
+    "page", "size KB", "parser", "full", "strained", "speedup"))
+  for path in sorted(glob.glob(FIXTURES)):
+    with open(path, "rb") as f:
+      html = f.read()
+    pages.append(html)
+    for parser in parsers:
+      full = parse_with(html, parser, None)
+      strained = parse_with(html, parser, encore.RESULTS)
+      if full != strained:
+        raise SystemExit("{} parses differently with {}: {} != {}".format(
+          path, parser, full, strained))
+      full_time = median_time(lambda: parse_with(html, parser, None), runs)
+      strained_time = median_time(lambda: parse_with(html, parser, encore.RESULTS), runs)
+      print("{:<18} {:>8} {:<12} {:>8.1f}ms {:>8.1f}ms {:>7.1f}x".format(
+        os.path.basename(path), len(html) // 1024, parser, full_time * 1000,
+        strained_time * 1000, full_time / strained_time))
+
+  batch = (pages * BATCH)[:BATCH]
+  # Start the pool before timing, since a real run pays that once.
+  batch_time(pages, 0)
+  print()
+  if encore.POOL_SIZE < 2:
+    print("Only one CPU, so the process pool isn't used.")
+  print("{} pages from {} threads, {} processes in the pool".format(
+    BATCH, THREADS, encore.POOL_SIZE))
+  for name, inline_parses in (("in process", THREADS), ("process pool", encore.INLINE_PARSES)):
+    print("{:<14} {:>8.1f}ms".format(name, batch_time(batch, inline_parses) * 1000))
+
+
+if __name__ == "__main__":
+  main(sys.argv)
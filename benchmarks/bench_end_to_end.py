@@ -0,0 +1,204 @@
+#! /usr/bin/env python3
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure how fast lists of books are looked up, against replay_server.py.
+
+Nothing here talks to the real providers. A replay server is started in this process,
+library.py is pointed at it, and lists of each size are looked up three ways:
+
+  find_book  one book at a time
+  library    library() on a Goodreads CSV, with its worker threads
+  page       find.cgi's page() for the same list pasted into the form
+
+Some of the books are ones the saved pages are about, so every kind of result comes
+up, and the rest aren't found anywhere, which is the slow, common case. The provider
+cache is bypassed, so every book is really looked up. The sources are asked in a fixed
+order, as with library.py --order fixed, and daemon.py is never used, even if it's
+running.
+
+For each run, the report is books per second, the median and 95th percentile time to
+look up one book, and how many requests each provider's host got.
+
+Usage: bench_end_to_end.py [--sizes 10,100,1000] [--latency MS] [--jitter MS]
+                           [--error-rate P] [--workers N] [--rate R]
+"""
+
+import argparse
+import contextlib
+import importlib.machinery
+import importlib.util
+import io
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WWW = os.path.join(ROOT, "www")
+sys.path.insert(0, ROOT)
+sys.path.insert(1, WWW)
+
+import replay_server
+
+WORDS = ("silent", "river", "glass", "empire", "winter", "garden", "stranger", "clock",
+         "harbor", "ash", "lantern", "orchard", "sparrow", "machine", "salt", "kingdom")
+NAMES = ("Ada", "Basil", "Cora", "Desmond", "Edith", "Felix", "Greta", "Hugo",
+         "Okafor", "Lindqvist", "Moreau", "Tanaka", "Ferreira", "Novak", "Quist", "Abara")
+
+
+def make_books(count, seed=0):
+  """A reading list with one book in five from the saved pages."""
+  rand = random.Random(seed)
+  books = []
+  for i in range(count):
+    if rand.random() < 0.2:
+      books.append(rand.choice(replay_server.RECORDED_BOOKS))
+      continue
+    title = "The {} {} {}".format(rand.choice(WORDS).title(), rand.choice(WORDS).title(), i)
+    if rand.random() < 0.2:
+      title += " ({} Cycle, #{})".format(rand.choice(WORDS).title(), rand.randint(1, 9))
+    books.append((title, "{} {}".format(rand.choice(NAMES), rand.choice(NAMES))))
+  return books
+
+
+def as_csv(books):
+  f = io.StringIO()
+  f.write("Title,Author,Bookshelves\n")
+  for title, author in books:
+    f.write('"{}","{}",to-read\n'.format(title.replace('"', '""'), author))
+  return f.getvalue()
+
+
+def load_find_cgi():
+  loader = importlib.machinery.SourceFileLoader("find_cgi", os.path.join(WWW, "find.cgi"))
+  spec = importlib.util.spec_from_loader(loader.name, loader)
+  module = importlib.util.module_from_spec(spec)
+  loader.exec_module(module)
+  # cgitb would print tracebacks as HTML.
+  sys.excepthook = sys.__excepthook__
+  return module
+
+
+def percentile(times, p):
+  if len(times) < 2:
+    return times[0] if times else 0
+  return statistics.quantiles(times, n=100, method="inclusive")[p - 1]
+
+
+def measure(server, library, run):
+  """Call run, timing each find_book call, and return (seconds, times, request counts)."""
+  times = []
+  find_book = library.find_book
+
+  def timed(*args):
+    start = time.perf_counter()
+    try:
+      return find_book(*args)
+    finally:
+      times.append(time.perf_counter() - start)
+
+  server.reset()
+  library.minuteman_search.clear()
+  library.find_book = timed
+  try:
+    with contextlib.redirect_stderr(io.StringIO()):
+      start = time.perf_counter()
+      run()
+      elapsed = time.perf_counter() - start
+  finally:
+    library.find_book = find_book
+  with server.lock:
+    counts = dict(server.counts)
+  return elapsed, times, counts
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Benchmark lookups against replayed providers.")
+  parser.add_argument("--sizes", default="10,100,1000",
+                      help="comma separated list sizes (default: %(default)s)")
+  parser.add_argument("--latency", type=float, default=20,
+                      help="average milliseconds per response (default: %(default)s)")
+  parser.add_argument("--jitter", type=float, default=5,
+                      help="standard deviation of the delay in milliseconds (default: %(default)s)")
+  parser.add_argument("--error-rate", type=float, default=0.0,
+                      help="fraction of requests that fail with a 503 (default: %(default)s)")
+  parser.add_argument("--workers", type=int, default=None,
+                      help="lookup threads for library and page (default: library.WORKERS)")
+  parser.add_argument("--rate", type=float, default=1000,
+                      help="requests per second allowed to the replay server (default: %(default)s)")
+  args = parser.parse_args(argv[1:])
+
+  server = replay_server.start(latency=args.latency / 1000, jitter=args.jitter / 1000,
+                               error_rate=args.error_rate)
+  os.environ.update(server.environment())
+
+  with tempfile.TemporaryDirectory() as tmp:
+    # Keep the runs from learning from, or teaching, the real source statistics, and
+    # from being sent to a daemon.py that's running the installed code.
+    os.environ["LIBRARY_SOURCE_STATS"] = os.path.join(tmp, "sources.json")
+    os.environ["LIBRARY_DAEMON_SOCKET"] = os.path.join(tmp, "no_daemon.sock")
+    import cache
+    import library
+    import throttle
+    find_cgi = load_find_cgi()
+
+    workers = args.workers or library.WORKERS
+    throttle.set_rate("127.0.0.1", args.rate, max(1, int(args.rate)))
+    subdomains = library.OVERDRIVE_SUBDOMAINS
+    # As with --order fixed, so every run asks the sources in the same order.
+    library.source_order.adaptive = False
+    library.use_daemon = False
+
+    cache.CACHE_PATH = os.path.join(tmp, "cache.sqlite")
+    cache.bypass = True
+    library.GUTINDEX_PATH = os.path.join(tmp, "gutindex.cat")
+    library.GUTINDEX_META_PATH = os.path.join(tmp, "gutindex.json")
+    library.LEGACY_GUTINDEX_PATH = os.path.join(tmp, "gutindex.pkl")
+    # page() reads its template, and the hidden books, from the current directory.
+    os.symlink(os.path.join(WWW, "books.template.html"), os.path.join(tmp, "books.template.html"))
+    os.chdir(tmp)
+
+    start = time.perf_counter()
+    library.gutenberg("", "")
+    print("Gutenberg catalog built from the replay in {:.1f}ms".format(
+      (time.perf_counter() - start) * 1000))
+    print("{:.0f}ms latency, {:.0f}ms jitter, {:.0%} errors, {} workers".format(
+      args.latency, args.jitter, args.error_rate, workers))
+    print()
+    print("{:<10} {:>6} {:>10} {:>9} {:>9}  {}".format(
+      "benchmark", "books", "books/s", "p50", "p95", "requests"))
+
+    for size in (int(size) for size in args.sizes.split(",")):
+      books = make_books(size)
+      runs = (
+        ("find_book", lambda: [library.find_book(title, author, subdomains)
+                               for title, author in books]),
+        ("library", lambda: library.library(io.StringIO(as_csv(books)), subdomains, workers)),
+        ("page", lambda: find_cgi.page(as_csv(books), None, ",".join(subdomains))),
+      )
+      for name, run in runs:
+        with contextlib.redirect_stdout(io.StringIO()):
+          elapsed, times, counts = measure(server, library, run)
+        print("{:<10} {:>6} {:>10.1f} {:>7.1f}ms {:>7.1f}ms  {}".format(
+          name, size, size / elapsed, percentile(times, 50) * 1000,
+          percentile(times, 95) * 1000,
+          " ".join("{}={}".format(host, count) for host, count in sorted(counts.items()))))
+
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1,127 @@
+#! /usr/bin/env python3
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare gutmatch.lookup with the old gutenberg_lookup on a labeled list.
+
+testdata/gutmatch/labeled.csv has Goodreads-style titles with the ebook number each
+should match in testdata/gutmatch/GUTINDEX.labeled, or none. Both matchers look up
+every book, and the report is:
+
+  recall     labeled books matched to the right ebook
+  wrong      books matched to a different ebook, or that should have no match
+  books/s    how many books are matched per second
+
+The catalog is padded with synthetic records to about the size of GUTINDEX.ALL, so
+the speeds are realistic. Books each matcher got wrong are listed after.
+
+Usage: bench_gutmatch.py [padding] [runs]
+"""
+
+import csv
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import catalog
+import gutmatch
+import library
+
+FIXTURES = os.path.join(ROOT, "testdata", "gutmatch")
+PADDING = 70000
+
+
+def read_labeled():
+  with open(os.path.join(FIXTURES, "labeled.csv"), newline="") as f:
+    return [(row["Title"], row["Author"], row["Ebook No."] or None) for row in csv.DictReader(f)]
+
+
+def padding_records(count):
+  """Records that look like the catalog, with ebook numbers above any real one."""
+  random.seed(0)
+  words = ["the", "of", "and", "witch", "world", "history", "letters", "voyage", "poems",
+           "king", "daughter", "england", "war", "life", "adventures", "volume", "essays",
+           "island", "garden", "tales", "wonder", "darkness", "travels", "sea", "time"]
+  names = ["dunsany", "cavendish", "austen", "dickens", "twain", "shelley", "eliot", "wells",
+           "verne", "doyle", "london", "kipling", "joyce", "wilde", "hugo", "dumas"]
+  for n in range(count):
+    title = " ".join(random.choice(words) for _ in range(random.randint(2, 8)))
+    author = "{} {}".format(random.choice(names), random.choice(names))
+    yield title, author, str(100000 + n)
+
+
+def with_lookup(gutindex, books):
+  found = []
+  for title, author in books:
+    record = library.gutenberg_lookup(gutindex, title, author)
+    found.append(record[2] if record else None)
+  return found
+
+
+def with_gutmatch(gutindex, books):
+  found = []
+  for title, author in books:
+    record = gutmatch.lookup(gutindex, title, author)
+    found.append(record[2] if record else None)
+  return found
+
+
+def main(argv):
+  padding = int(argv[1]) if len(argv) > 1 else PADDING
+  runs = int(argv[2]) if len(argv) > 2 else 3
+  labeled = read_labeled()
+  books = [(library.extract_title(title)["title"], author) for title, author, _ in labeled]
+  with open(os.path.join(FIXTURES, "GUTINDEX.labeled")) as f:
+    records = list(library.parse_gutenberg(f))
+
+  with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, "gutindex.cat")
+    catalog.write(path, records + list(padding_records(padding)))
+    gutindex = catalog.Catalog(path)
+    print("{} labeled books, {} with a match, against {} records".format(
+      len(labeled), sum(1 for _, _, expected in labeled if expected), len(gutindex)))
+    print()
+    print("{:<18} {:>7} {:>6} {:>9}".format("matcher", "recall", "wrong", "books/s"))
+    misses = {}
+    for name, match in (("gutenberg_lookup", with_lookup), ("gutmatch", with_gutmatch)):
+      times = []
+      for _ in range(runs):
+        start = time.perf_counter()
+        found = match(gutindex, books)
+        times.append(time.perf_counter() - start)
+      right = sum(1 for (_, _, expected), got in zip(labeled, found) if expected and got == expected)
+      wrong = sum(1 for (_, _, expected), got in zip(labeled, found) if got and got != expected)
+      positives = sum(1 for _, _, expected in labeled if expected)
+      print("{:<18} {:>6.0%} {:>6} {:>9.1f}".format(
+        name, right / positives, wrong, len(books) / statistics.median(times)))
+      misses[name] = [(title, author, expected, got)
+                      for (title, author, expected), got in zip(labeled, found) if got != expected]
+    gutindex.close()
+
+  for name, missed in misses.items():
+    print()
+    print("{} got wrong:".format(name))
+    for title, author, expected, got in missed:
+      print("  {} by {}: expected {}, got {}".format(title, author, expected, got))
+
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1,101 @@
+#! /usr/bin/env python3
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare the two ways of reading mediaItems from an Overdrive search page.
+
+"text" decodes the whole page, finds the line and decodes one object from the rest of
+the text, the way overdrive() used to. "bytes" is mediaitems.media_items, fed the page
+in chunks as if it were downloading. Both have to find the same books.
+
+For each saved page in testdata/overdrive, the report is how much of the page was
+read, the most memory allocated at once while reading it, and the median time per
+call.
+
+Usage: bench_overdrive_extract.py [runs]
+"""
+
+import glob
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import mediaitems
+
+FIXTURES = os.path.join(ROOT, "testdata", "overdrive", "*.html")
+
+
+def text(page, read):
+  read[0] = len(page)
+  page_text = page.decode("utf-8")
+  match = "window.OverDrive.mediaItems = "
+  start = page_text.find(match)
+  if start == -1:
+    return None
+  return mediaitems.slim(json.JSONDecoder().raw_decode(page_text[start + len(match):])[0])
+
+
+def chunks(page, read):
+  for i in range(0, len(page), mediaitems.CHUNK_SIZE):
+    chunk = page[i:i + mediaitems.CHUNK_SIZE]
+    read[0] += len(chunk)
+    yield chunk
+
+
+def by_bytes(page, read):
+  read[0] = 0
+  return mediaitems.media_items(chunks(page, read))
+
+
+def measure(extract, page, runs):
+  read = [0]
+  tracemalloc.start()
+  result = extract(page, read)
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  times = []
+  for _ in range(runs):
+    start = time.perf_counter()
+    extract(page, [0])
+    times.append(time.perf_counter() - start)
+  return result, read[0], peak, statistics.median(times)
+
+
+def main(argv):
+  runs = int(argv[1]) if len(argv) > 1 else 200
+  print("{:<18} {:>8} {:<6} {:>8} {:>10} {:>10}".format(
+    "page", "size KB", "method", "read KB", "peak KB", "per call"))
+  for path in sorted(glob.glob(FIXTURES)):
+    with open(path, "rb") as f:
+      page = f.read()
+    results = []
+    for name, extract in (("text", text), ("bytes", by_bytes)):
+      result, read, peak, elapsed = measure(extract, page, runs)
+      results.append(result)
+      print("{:<18} {:>8} {:<6} {:>8} {:>10} {:>8.2f}ms".format(
+        os.path.basename(path), len(page) // 1024, name, read // 1024, peak // 1024,
+        elapsed * 1000))
+    if results[0] != results[1]:
+      raise SystemExit("{} gives different books".format(path))
+
+
+if __name__ == "__main__":
+  main(sys.argv)
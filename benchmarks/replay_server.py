@@ -0,0 +1,200 @@
+#! /usr/bin/env python3
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local stand-in for every book provider, replaying the pages saved in testdata.
+
+Each request is answered with the saved page whose book is in the query, or with the
+provider's "no results" page, after a configurable delay. Some fraction of requests
+can fail with a 503 instead. Requests are counted by the real host they stand in for,
+and the counts are at /_counts as JSON.
+
+library.py uses it when its provider URLs point here, which this prints on startup:
+
+  LIBRARY_OVERDRIVE_URL=http://127.0.0.1:PORT/overdrive/{subdomain}
+  LIBRARY_MINUTEMAN_URL=http://127.0.0.1:PORT/minuteman
+  LIBRARY_OPEN_LIBRARY_URL=http://127.0.0.1:PORT/openlibrary
+  LIBRARY_GUTINDEX_URL=http://127.0.0.1:PORT/gutenberg/dirs/GUTINDEX.ALL
+  LIBRARY_GOOGLE_BOOKS_URL=http://127.0.0.1:PORT/googlebooks
+
+metadata.py uses the last one.
+
+Since every provider is on the same host here, its rate limit should be raised, with
+library.py's --rate 127.0.0.1=RATE.
+
+Usage: replay_server.py [--port PORT] [--latency MS] [--jitter MS] [--error-rate P]
+"""
+
+import argparse
+import collections
+import http.server
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTDATA = os.path.join(ROOT, "testdata")
+
+# For each provider: its path here, the host it stands in for, the saved page for
+# queries mentioning each book, and the page for everything else.
+PROVIDERS = (
+  ("overdrive", "{}.overdrive.com", "text/html; charset=utf-8",
+   (("Blazing World", "overdrive/available.html"),
+    ("Middlemarch", "overdrive/waitlist.html")),
+   "overdrive/no_results.html"),
+  ("minuteman", "find.minlib.net", "text/html; charset=UTF-8",
+   (("Blazing World", "encore/hoopla.html"),
+    ("Left Hand of Darkness", "encore/holdings.html"),
+    ("Middlemarch", "encore/mixed.html")),
+   "encore/no_results.html"),
+  ("openlibrary", "openlibrary.org", "application/json",
+   (("Left Hand of Darkness", "openlibrary/borrowable.json"),
+    ("Middlemarch", "openlibrary/waitlist.json")),
+   "openlibrary/no_results.json"),
+  ("gutenberg", "www.gutenberg.org", "text/plain; charset=utf-8",
+   (), "GUTINDEX.sample"),
+  ("googlebooks", "www.googleapis.com", "application/json",
+   (("Blazing World", "googlebooks/blazing_world.json"),
+    ("Middlemarch", "googlebooks/middlemarch.json"),
+    ("9780141439549", "googlebooks/middlemarch.json")),
+   "googlebooks/no_results.json"),
+)
+
+# The books that the saved pages are about, for making lists that find some of them.
+RECORDED_BOOKS = (
+  ("The Blazing World", "Margaret Cavendish"),
+  ("The Left Hand of Darkness", "Ursula K. Le Guin"),
+  ("Middlemarch", "George Eliot"),
+  ("Tales of Wonder", "Lord Dunsany"),
+  ("Pride and Prejudice", "Jane Austen"),
+)
+
+
+class Replay(http.server.ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address, latency=0.0, jitter=0.0, error_rate=0.0):
+    super().__init__(address, Handler)
+    self.latency = latency
+    self.jitter = jitter
+    self.error_rate = error_rate
+    self.counts = collections.Counter()
+    self.lock = threading.Lock()
+    self.pages = {}
+    for _, _, _, recorded, default in PROVIDERS:
+      for path in [page for _, page in recorded] + [default]:
+        with open(os.path.join(TESTDATA, path), "rb") as f:
+          self.pages[path] = f.read()
+
+  @property
+  def url(self):
+    return "http://{}:{}".format(*self.server_address[:2])
+
+  def environment(self):
+    """The settings that point library.py here."""
+    return {"LIBRARY_OVERDRIVE_URL": self.url + "/overdrive/{subdomain}",
+            "LIBRARY_MINUTEMAN_URL": self.url + "/minuteman",
+            "LIBRARY_OPEN_LIBRARY_URL": self.url + "/openlibrary",
+            "LIBRARY_GUTINDEX_URL": self.url + "/gutenberg/dirs/GUTINDEX.ALL",
+            "LIBRARY_GOOGLE_BOOKS_URL": self.url + "/googlebooks"}
+
+  def handle_error(self, request, client_address):
+    # Clients hang up early on purpose, like overdrive() once it has read the books.
+    if not isinstance(sys.exc_info()[1], ConnectionError):
+      super().handle_error(request, client_address)
+
+  def reset(self):
+    with self.lock:
+      self.counts.clear()
+
+  def count(self, host):
+    with self.lock:
+      self.counts[host] += 1
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, format, *args):
+    pass
+
+  def send(self, status, content_type, body):
+    self.send_response(status)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    if self.path == "/_counts":
+      with self.server.lock:
+        self.send(200, "application/json", json.dumps(self.server.counts).encode())
+      return
+    _, provider, rest = (self.path.split("/", 2) + ["", ""])[:3]
+    for name, host, content_type, recorded, default in PROVIDERS:
+      if name == provider:
+        break
+    else:
+      self.send(404, "text/plain", b"Not recorded\n")
+      return
+    if name == "overdrive":
+      subdomain, _, rest = rest.partition("/")
+      host = host.format(subdomain)
+    self.server.count(host)
+
+    delay = random.gauss(self.server.latency, self.server.jitter)
+    time.sleep(max(0.0, delay))
+    if random.random() < self.server.error_rate:
+      self.send(503, "text/plain", b"Replayed failure\n")
+      return
+    query = urllib.parse.unquote_plus(rest)
+    page = default
+    for book, path in recorded:
+      if book.lower() in query.lower():
+        page = path
+        break
+    self.send(200, content_type, self.server.pages[page])
+
+
+def start(port=0, latency=0.0, jitter=0.0, error_rate=0.0):
+  """Run a replay server on a background thread, and return it."""
+  server = Replay(("127.0.0.1", port), latency, jitter, error_rate)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Replay saved provider pages.")
+  parser.add_argument("--port", type=int, default=8765)
+  parser.add_argument("--latency", type=float, default=200,
+                      help="average milliseconds before each response (default: %(default)s)")
+  parser.add_argument("--jitter", type=float, default=50,
+                      help="standard deviation of the delay in milliseconds (default: %(default)s)")
+  parser.add_argument("--error-rate", type=float, default=0.0,
+                      help="fraction of requests that fail with a 503 (default: %(default)s)")
+  args = parser.parse_args()
+  server = Replay(("127.0.0.1", args.port), args.latency / 1000, args.jitter / 1000,
+                  args.error_rate)
+  for name, value in server.environment().items():
+    print("export {}='{}'".format(name, value), flush=True)
+  server.serve_forever()
+
+
+if __name__ == "__main__":
+  main()
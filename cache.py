@@ -0,0 +1,216 @@
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A persistent cache of what each provider said about each book.
+
+Most books don't change status from one day to the next, so there's no need to ask
+every library about every book on every run. Results are kept in SQLite, keyed by the
+provider and its normalized arguments, and each provider decides how long a result
+stays fresh, separately for when it found the book and when it didn't.
+
+After a result goes stale it can still be served for a while, as long as a fresh copy
+is fetched in the background for next time.
+"""
+
+import concurrent.futures
+import functools
+import json
+import os
+import re
+import sqlite3
+import stats
+import sys
+import threading
+import time
+
+
+CACHE_PATH = os.environ.get("LIBRARY_CACHE", "/tmp/library_cache.sqlite")
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+# Set to skip reading the cache. Fresh results are still saved.
+bypass = False
+
+store = None
+store_lock = threading.Lock()
+
+refreshes = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+refreshing = set()
+refreshing_lock = threading.Lock()
+
+
+class Store:
+  """One SQLite connection shared by every thread, with its own lock."""
+
+  def __init__(self, path):
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    with self.lock, self.db:
+      self.db.execute("PRAGMA journal_mode=WAL")
+      self.db.execute("""CREATE TABLE IF NOT EXISTS results (
+                           provider TEXT,
+                           key TEXT,
+                           value TEXT,
+                           found INTEGER,
+                           stored REAL,
+                           PRIMARY KEY (provider, key))""")
+
+  def get(self, provider, key):
+    """Return (value, found, when it was stored), or None."""
+    with self.lock:
+      row = self.db.execute("SELECT value, found, stored FROM results WHERE provider = ? AND key = ?",
+                            (provider, key)).fetchone()
+    if row is None:
+      return None
+    return json.loads(row[0]), bool(row[1]), row[2]
+
+  def put(self, provider, key, value, found):
+    with self.lock, self.db:
+      self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                      (provider, key, json.dumps(value), int(bool(found)), time.time()))
+
+
+def get_store():
+  global store
+  with store_lock:
+    if store is None:
+      store = Store(CACHE_PATH)
+  return store
+
+
+def normalize(arg):
+  """Reduce an argument to lowercase words, so trivial differences share an entry."""
+  return " ".join(re.findall(r"\w+", str(arg or "").lower()))
+
+
+class SingleFlight:
+  """Let threads that make the same call at the same time share one call."""
+
+  def __init__(self):
+    self.calls = {}
+    self.lock = threading.Lock()
+
+  def call(self, key, fn, *args):
+    """Return fn(*args), or wait for the result of a call already in flight for key."""
+    with self.lock:
+      future = self.calls.get(key)
+      leader = future is None
+      if leader:
+        future = self.calls[key] = concurrent.futures.Future()
+    if not leader:
+      return future.result()
+    try:
+      value = fn(*args)
+    except BaseException as e:
+      future.set_exception(e)
+      raise
+    else:
+      future.set_result(value)
+      return value
+    finally:
+      with self.lock:
+        del self.calls[key]
+
+
+def per_run(fn):
+  """Remember a function's results in memory, so its callers can share one fetch per run.
+
+  Callers asking at the same time wait for the first one's fetch."""
+  results = {}
+  lock = threading.Lock()
+  flights = SingleFlight()
+
+  def fetch(*args):
+    value = fn(*args)
+    with lock:
+      results[args] = value
+    return value
+
+  @functools.wraps(fn)
+  def wrapper(*args):
+    with lock:
+      if args in results:
+        return results[args]
+    return flights.call(args, fetch, *args)
+
+  wrapper.clear = results.clear
+  return wrapper
+
+
+def cached(provider, positive_ttl, negative_ttl, found, stale_ttl=DAY, refresh_when=None):
+  """Cache a provider function's results.
+
+  found tells whether a result means the provider has the book. Results are fresh for
+  positive_ttl or negative_ttl seconds, depending on that, and after that are served
+  for up to stale_ttl more seconds while they are refreshed in the background. If
+  refresh_when is given, a stale result is only refreshed while it returns true, and
+  is otherwise just served.
+
+  The cache is only an optimization, so if it can't be read or written the provider is
+  just called directly. Identical lookups that miss at the same time share one call."""
+  def decorator(fn):
+    flights = SingleFlight()
+
+    def lookup(key, args):
+      value = fn(*args)
+      try:
+        get_store().put(provider, key, value, found(value))
+      except sqlite3.Error as e:
+        sys.stderr.write("Not caching {}: {}\n".format(provider, e))
+      return value
+
+    def refresh(key, args):
+      try:
+        if refresh_when is None or refresh_when():
+          lookup(key, args)
+      except Exception as e:
+        sys.stderr.write("Refreshing {} failed: {}\n".format(provider, e))
+      finally:
+        with refreshing_lock:
+          refreshing.discard((provider, key))
+
+    @functools.wraps(fn)
+    def wrapper(*args):
+      key = "\x1f".join(normalize(arg) for arg in args)
+      entry = None
+      if not bypass:
+        try:
+          entry = get_store().get(provider, key)
+        except sqlite3.Error as e:
+          sys.stderr.write("Not reading cache for {}: {}\n".format(provider, e))
+      if entry is not None:
+        value, hit, stored = entry
+        age = time.time() - stored
+        ttl = positive_ttl if hit else negative_ttl
+        if age < ttl:
+          stats.cache_outcome(provider, "hit")
+          return value
+        if age < ttl + stale_ttl:
+          stats.cache_outcome(provider, "stale")
+          if refresh_when is not None and not refresh_when():
+            return value
+          with refreshing_lock:
+            if (provider, key) in refreshing:
+              return value
+            refreshing.add((provider, key))
+          refreshes.submit(refresh, key, args)
+          return value
+      stats.cache_outcome(provider, "bypass" if bypass else "miss")
+      return flights.call(key, lookup, key, args)
+
+    wrapper.uncached = fn
+    return wrapper
+  return decorator
@@ -0,0 +1,234 @@
+#! /usr/bin/env python3
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A compact on-disk format for the Project Gutenberg catalog.
+
+Every CGI request is a fresh process, so loading the catalog has to be cheap. Instead
+of unpickling a dict of every record, the catalog is written as a few flat tables that
+can be memory-mapped and searched in place:
+
+  header     magic, format version, record and word counts, and the section table
+  records    three uint32s per record: title string, author string, ebook number
+  strings    offsets into a blob of UTF-8 titles and authors
+  vocab      offsets into a blob of the sorted, distinct record words, each followed
+             by a newline, so one substring search covers the whole vocabulary. Each
+             word is there as written and as gutmatch.fold writes it, so "émile" and
+             "walden." can also be found as "emile" and "walden".
+  postings   offsets into one array of record numbers for each word
+
+Records are numbered in catalog order. All integers are little-endian.
+"""
+
+from array import array
+import bisect
+import gutmatch
+import mmap
+import re
+import struct
+import sys
+import util
+
+
+MAGIC = b"GUTC"
+# Version 2 added the folded words.
+VERSION = 2
+
+HEADER = struct.Struct("<4sHHII")
+SECTION = struct.Struct("<II")
+SECTIONS = ("records", "string_offsets", "strings",
+            "vocab_offsets", "vocab", "posting_offsets", "postings")
+
+NO_AUTHOR = 0xFFFFFFFF
+
+
+class CatalogError(Exception):
+  pass
+
+
+WORD_SEPARATORS = re.compile(r'[-\s,:;\(\)]')
+
+
+def _uint32s(values):
+  data = array("I", values)
+  if sys.byteorder == "big":
+    data.byteswap()
+  return data.tobytes()
+
+
+def write(path, records):
+  """Write (title, author, ebook number) records to path.
+
+  The file is written next to its final location and moved into place, so a reader
+  never sees a partial catalog. records can be a generator. Only the distinct strings
+  and the tables are held, with the tables in arrays of uint32s rather than lists of
+  ints."""
+  strings = {}
+  string_offsets = array("I", [0])
+  blob = []
+
+  def string_id(s):
+    if s not in strings:
+      encoded = s.encode("utf8")
+      strings[s] = len(blob)
+      blob.append(encoded)
+      string_offsets.append(string_offsets[-1] + len(encoded))
+    return strings[s]
+
+  fields = array("I")
+  postings = {}
+  folded = {}
+  for i, (title, author, ebook_no) in enumerate(records):
+    fields.append(string_id(title))
+    fields.append(NO_AUTHOR if author is None else string_id(author))
+    fields.append(int(ebook_no))
+    for field in (title, author):
+      if not field:
+        continue
+      for word in WORD_SEPARATORS.split(field):
+        if not word:
+          continue
+        if word not in folded:
+          folded[word] = set(gutmatch.fold(word)) | {word}
+        for indexed in folded[word]:
+          posting = postings.get(indexed)
+          if posting is None:
+            posting = postings[indexed] = array("I")
+          if not posting or posting[-1] != i:
+            posting.append(i)
+
+  vocab = sorted(postings)
+  vocab_offsets = [0]
+  encoded_vocab = []
+  for word in vocab:
+    encoded = word.encode("utf8") + b"\n"
+    encoded_vocab.append(encoded)
+    vocab_offsets.append(vocab_offsets[-1] + len(encoded))
+  posting_offsets = array("I", [0])
+  all_postings = array("I")
+  for word in vocab:
+    all_postings.extend(postings[word])
+    posting_offsets.append(len(all_postings))
+
+  sections = [_uint32s(fields),
+              _uint32s(string_offsets),
+              b"".join(blob),
+              _uint32s(vocab_offsets),
+              b"".join(encoded_vocab),
+              _uint32s(posting_offsets),
+              _uint32s(all_postings)]
+  offset = HEADER.size + SECTION.size * len(sections)
+  table = []
+  for section in sections:
+    offset += -offset % 4
+    table.append((offset, len(section)))
+    offset += len(section)
+
+  def write_sections(f):
+    f.write(HEADER.pack(MAGIC, VERSION, 0, len(fields) // 3, len(vocab)))
+    for entry in table:
+      f.write(SECTION.pack(*entry))
+    for (start, _), section in zip(table, sections):
+      f.write(b"\0" * (start - f.tell()))
+      f.write(section)
+  util.write_atomically(path, write_sections, binary=True)
+
+
+class Catalog:
+  """A memory-mapped catalog, read without loading the records into Python objects."""
+
+  def __init__(self, path):
+    if sys.byteorder != "little":
+      raise CatalogError("Catalog files can only be mapped on little-endian machines")
+    with open(path, "rb") as f:
+      self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(self.mm) < HEADER.size:
+      raise CatalogError("{} is too short to be a catalog".format(path))
+    magic, version, _, self.record_count, self.word_count = HEADER.unpack_from(self.mm)
+    if magic != MAGIC:
+      raise CatalogError("{} is not a catalog".format(path))
+    if version != VERSION:
+      raise CatalogError("{} is catalog version {}, expected {}".format(path, version, VERSION))
+    self.view = memoryview(self.mm)
+    self.sections = {}
+    for i, name in enumerate(SECTIONS):
+      start, length = SECTION.unpack_from(self.mm, HEADER.size + SECTION.size * i)
+      self.sections[name] = (start, start + length)
+      if start + length > len(self.mm):
+        raise CatalogError("{} is truncated".format(path))
+    self.tables = {}
+    for name in ("records", "string_offsets", "vocab_offsets", "posting_offsets", "postings"):
+      start, end = self.sections[name]
+      self.tables[name] = self.view[start:end].cast("I")
+
+  def __len__(self):
+    return self.record_count
+
+  def string(self, i):
+    start = self.sections["strings"][0]
+    offsets = self.tables["string_offsets"]
+    return self.mm[start + offsets[i]:start + offsets[i + 1]].decode("utf8")
+
+  def record(self, i):
+    """Return the (title, author, ebook number) record with this number."""
+    records = self.tables["records"]
+    author = records[3 * i + 1]
+    return (self.string(records[3 * i]),
+            None if author == NO_AUTHOR else self.string(author),
+            str(records[3 * i + 2]))
+
+  def __iter__(self):
+    for i in range(self.record_count):
+      yield self.record(i)
+
+  def postings(self, word):
+    """Return the posting lists of every indexed word that contains this word.
+
+    A query word never contains a separator, so it can only be found inside a single
+    record word. That makes this the same as a substring search of each record."""
+    start, end = self.sections["vocab"]
+    vocab_offsets = self.tables["vocab_offsets"]
+    posting_offsets = self.tables["posting_offsets"]
+    postings = self.tables["postings"]
+    needle = word.encode("utf8")
+    found = []
+    pos = self.mm.find(needle, start, end)
+    while pos != -1:
+      i = bisect.bisect_right(vocab_offsets, pos - start) - 1
+      found.append(postings[posting_offsets[i]:posting_offsets[i + 1]])
+      pos = self.mm.find(needle, start + vocab_offsets[i + 1], end)
+    return found
+
+  def word_postings(self, word):
+    """Return the posting list of exactly this indexed word, which is empty if there
+    isn't one."""
+    start, end = self.sections["vocab"]
+    needle = word.encode("utf8") + b"\n"
+    if self.mm[start:start + len(needle)] == needle:
+      pos = start
+    else:
+      pos = self.mm.find(b"\n" + needle, start, end)
+      if pos == -1:
+        return self.tables["postings"][0:0]
+      pos += 1
+    i = bisect.bisect_right(self.tables["vocab_offsets"], pos - start) - 1
+    posting_offsets = self.tables["posting_offsets"]
+    return self.tables["postings"][posting_offsets[i]:posting_offsets[i + 1]]
+
+  def close(self):
+    for table in self.tables.values():
+      table.release()
+    self.view.release()
+    self.mm.close()
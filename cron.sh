@@ -23,6 +23,20 @@ mkdir -p $log
 ROOT=$HOME/projects/find-libraries-for-books
 
 cd $ROOT
-./library.py $HOME/to_read.csv > $HOME/available_books.json 2>/dev/null
-cp $HOME/available_books.json $log/availale_books-`date -Iminutes`.json
-
+# Usually a 304 or a handful of new records, rather than the whole catalog.
+./library.py --refresh-gutenberg 2>/dev/null
+# Only books that are new or may have changed are looked up, and the history keeps just
+# what was added and removed each day.
+# --stats leaves timings for each provider in available_books.stats.json.
+# The output is only replaced once the run finishes. If it dies partway, say on a network
+# blip, it is tried once more, starting from the books it had already looked up.
+args=(--incremental $HOME/.available_books_state
+      --delta $log/available_books-`date -Iminutes`.delta.json
+      --output $HOME/available_books.json
+      --stats
+      $HOME/to_read.csv)
+./library.py "${args[@]}" 2>/dev/null || ./library.py --resume "${args[@]}" 2>/dev/null
+# Page counts and ISBNs, mostly from the cache after the first few runs.
+./metadata.py --csv $HOME/to_read.csv $HOME/available_books.json 2>/dev/null
+# Render the daily page ahead of time, so daily.cgi only has to send a file.
+(cd www && ./render.py)
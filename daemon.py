@@ -0,0 +1,293 @@
+#! /usr/bin/env python3
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A resident process that looks books up for find.cgi and library.py.
+
+Every CGI request used to import requests and Beautiful Soup, open the Gutenberg
+catalog and connect to each provider again, which for a short list took longer than
+the lookups. This process does all of that once, and keeps it: the catalog stays
+open, per-run results and source statistics stay in memory, and the connection pools
+stay connected. It listens on a Unix socket, at SOCKET_PATH unless
+LIBRARY_DAEMON_SOCKET says otherwise, which only its own user can connect to.
+
+It is optional. The client functions here raise NotRunning when nothing is listening,
+and the callers then do the lookups themselves. The client side only imports the
+standard library, so asking the daemon doesn't pay for what it is there to avoid.
+
+Each connection carries one request, a line of JSON with an "op", and gets back lines
+of JSON: the results as they are found, then {"done": true}, or {"error": message}.
+If the client hangs up early, the lookups for it stop.
+
+Run it as the Web server's user, so the CGI scripts can use the socket, and from www/,
+where the daily list is. That list, HISTORY, is the only one a client can ask to have
+books prioritized by, so the daemon doesn't read whatever file it's sent.
+
+Usage: daemon.py [serve|stats|stop] [--socket PATH] [--history PATH] [--rate DOMAIN=RATE]...
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import util
+
+
+SOCKET_PATH = os.environ.get("LIBRARY_DAEMON_SOCKET", "/tmp/library_daemon.sock")
+CONNECT_TIMEOUT = 1
+# The daily list, as find.cgi names it, relative to www/.
+HISTORY = os.environ.get("LIBRARY_DAEMON_HISTORY", "available_books.json")
+
+
+class DaemonError(Exception):
+  pass
+
+
+class NotRunning(DaemonError):
+  pass
+
+
+def connect(path=SOCKET_PATH):
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.settimeout(CONNECT_TIMEOUT)
+  try:
+    sock.connect(path)
+  except OSError as e:
+    # Including PermissionError, when the daemon is another user's, as it is when it
+    # runs as the Web server's user. Then the lookups are done without it.
+    sock.close()
+    raise NotRunning(e)
+  # Lookups can take a while, and the results come as they're found.
+  sock.settimeout(None)
+  return sock
+
+
+def request(op, path=SOCKET_PATH, **args):
+  """Send one request, and return a generator of the responses before "done".
+
+  Connects straight away, so NotRunning is raised here rather than while iterating."""
+  sock = connect(path)
+  try:
+    sock.sendall(json.dumps(dict(args, op=op)).encode() + b"\n")
+  except OSError as e:
+    sock.close()
+    raise NotRunning(e)
+
+  def responses():
+    with sock, sock.makefile("rb") as f:
+      for line in f:
+        response = json.loads(line)
+        if "error" in response:
+          raise DaemonError(response["error"])
+        if response.get("done"):
+          return
+        yield response
+      raise DaemonError("The daemon hung up before finishing")
+  return responses()
+
+
+def find_books(books, overdrive_subdomains=None, workers=None):
+  """Like library.find_books, with every result in list order."""
+  responses = request("find_books", books=list(books), overdrive=overdrive_subdomains,
+                      workers=workers)
+  return (response["book"] for response in responses)
+
+
+def iter_available(books, overdrive_subdomains=None, limit=None, history=None):
+  """Like library.iter_available. With a limit, the books are first sorted by
+  library.prioritize, using the books available in history."""
+  responses = request("iter_available", books=list(books), overdrive=overdrive_subdomains,
+                      limit=limit, history=history and os.path.abspath(history))
+  return (response["book"] for response in responses)
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, path, history=HISTORY):
+    self.path = path
+    self.history = os.path.realpath(history)
+    super().__init__(path, Handler)
+    self.gutindex_mtime = None
+    self.lock = threading.Lock()
+
+  def server_bind(self):
+    super().server_bind()
+    # Before listen(), so nobody else can connect in between.
+    os.chmod(self.path, 0o600)
+
+  def fresh_start(self):
+    """Forget what is only meant to last one run, before each request."""
+    import library
+    import transport
+
+    # Open the catalog again if library.py --refresh-gutenberg has replaced it, or it
+    # couldn't be loaded before.
+    try:
+      mtime = os.stat(library.GUTINDEX_PATH).st_mtime
+    except FileNotFoundError:
+      mtime = None
+    with self.lock:
+      if mtime != self.gutindex_mtime or library.gutindex == "not found":
+        self.gutindex_mtime = mtime
+        try:
+          with library.gutindex_lock:
+            library.load_gutenberg()
+        except Exception as e:
+          sys.stderr.write("Gutenberg catalog not loaded: {}\n".format(e))
+    # Results are cached for longer by cache.cached, so this is only the shared search.
+    library.minuteman_search.clear()
+    # A host that was down for an earlier request gets asked again, as in a new run.
+    transport.close_breakers()
+
+  def find_books(self, books, overdrive=None, workers=None):
+    import library
+
+    lookups = library.find_books([tuple(book) for book in books],
+                                 overdrive or library.OVERDRIVE_SUBDOMAINS,
+                                 workers or library.WORKERS)
+    with contextlib.closing(lookups):
+      for book in lookups:
+        yield {"book": book}
+
+  def iter_available(self, books, overdrive=None, limit=None, history=None):
+    import library
+
+    books = [tuple(book) for book in books]
+    if history and os.path.realpath(history) != self.history:
+      raise DaemonError("Only {} can be used as history".format(self.history))
+    if limit:
+      books = library.prioritize(books, library.recently_available(history))
+    available = library.iter_available(books, overdrive or library.OVERDRIVE_SUBDOMAINS,
+                                       limit=limit)
+    with contextlib.closing(available):
+      for book in available:
+        yield {"book": book}
+
+  def stats(self):
+    import stats
+
+    yield stats.report()
+
+  def stop(self):
+    threading.Thread(target=self.shutdown).start()
+    yield {"pid": os.getpid()}
+
+  def operation(self, name):
+    if name not in ("find_books", "iter_available", "stats", "stop"):
+      raise DaemonError("Unknown operation {}".format(name))
+    return getattr(self, name)
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+  def send(self, response):
+    self.wfile.write(json.dumps(response).encode() + b"\n")
+    self.wfile.flush()
+
+  def handle(self):
+    try:
+      args = json.loads(self.rfile.readline())
+      operation = self.server.operation(args.pop("op", None))
+      self.server.fresh_start()
+      with contextlib.closing(operation(**args)) as responses:
+        for response in responses:
+          self.send(response)
+      self.send({"done": True})
+    except (BrokenPipeError, ConnectionResetError):
+      # The client stopped listening, and closing the responses stopped the lookups.
+      pass
+    except Exception as e:
+      sys.stderr.write("{}: {}\n".format(type(e).__name__, e))
+      try:
+        self.send({"error": "{}: {}".format(type(e).__name__, e)})
+      except OSError:
+        pass
+
+
+def serve(path=SOCKET_PATH, history=HISTORY):
+  try:
+    connect(path).close()
+  except NotRunning:
+    pass
+  else:
+    sys.stderr.write("Already running at {}\n".format(path))
+    exit(1)
+  try:
+    # Left behind by a daemon that didn't stop cleanly.
+    os.remove(path)
+  except FileNotFoundError:
+    pass
+  except OSError as e:
+    # Probably another user's daemon, which this one can't replace.
+    sys.stderr.write("Can't remove {}: {}\n".format(path, e))
+    exit(1)
+
+  # Load the slow parts up front, so the first request doesn't wait for them.
+  import encore
+  import library
+  # Pool processes are worth starting in a process that lasts.
+  encore.use_pool = encore.POOL_SIZE > 1
+  server = Server(path, history)
+  signal.signal(signal.SIGTERM, lambda signum, frame: exit(0))
+  try:
+    server.fresh_start()
+    sys.stderr.write("Listening at {}\n".format(path))
+    server.serve_forever()
+  finally:
+    server.server_close()
+    try:
+      os.remove(path)
+    except OSError as e:
+      sys.stderr.write("Can't remove {}: {}\n".format(path, e))
+    library.source_order.save()
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(prog=argv[0], description=__doc__.split("\n\n")[0])
+  parser.add_argument("command", nargs="?", choices=("serve", "stats", "stop"), default="serve",
+                      help="run the daemon, or print a running one's request counts and "
+                      "latencies, or stop it (default: %(default)s)")
+  parser.add_argument("--socket", default=SOCKET_PATH,
+                      help="where to listen (default: %(default)s)")
+  parser.add_argument("--history", default=HISTORY,
+                      help="the daily list, the only history clients can ask for "
+                      "(default: %(default)s)")
+  parser.add_argument("--rate", action="append", default=[], metavar="DOMAIN=RATE",
+                      type=util.parse_rate,
+                      help="limit requests per second to DOMAIN and its subdomains, "
+                      "as in library.py (can be repeated)")
+  args = parser.parse_args(argv[1:])
+  if args.command == "serve":
+    import throttle
+    for domain, per_second in args.rate:
+      throttle.set_rate(domain, per_second)
+    serve(args.socket, args.history)
+    return
+  try:
+    for response in request(args.command, args.socket):
+      print(json.dumps(response, indent=2))
+  except NotRunning:
+    sys.stderr.write("Not running at {}\n".format(args.socket))
+    exit(1)
+
+
+if __name__ == "__main__":
+  main(sys.argv)
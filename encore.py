@@ -0,0 +1,107 @@
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Parsing of Minuteman's Encore search result pages.
+
+Most of an Encore page is navigation, facets and scripts, and only the
+div.searchResult blocks matter. So only those are built into a tree, with lxml if it's
+installed since it is much faster than Python's own parser.
+
+When lots of lookups run at once, parsing is the biggest CPU cost per book, and
+threads can't share it out because of the GIL. So with use_pool set, when another page
+is already being parsed, the next one is handed to a process pool instead. Starting
+the pool's processes costs more than it saves in a short-lived process like a CGI
+script, and there's nothing to gain with one CPU, so only daemon.py sets it, and only
+with more than one CPU. If the pool breaks, pages are parsed here again.
+"""
+
+from bs4 import BeautifulSoup, SoupStrainer
+import concurrent.futures
+import importlib.util
+import multiprocessing
+import os
+import sys
+import threading
+
+
+PARSER = "lxml" if importlib.util.find_spec("lxml") else "html.parser"
+
+# How many pages can be parsed in this process at once before using the pool.
+INLINE_PARSES = 1
+POOL_SIZE = os.cpu_count() or 1
+
+RESULTS = SoupStrainer("div", class_="searchResult")
+
+use_pool = False
+pool = None
+in_flight = 0
+lock = threading.Lock()
+
+
+def parse_results(html):
+  """Read Hoopla availability and physical holdings from an Encore results page.
+
+  Returns {"hoopla": False, True or a link to the book, "holdings": {location: status}},
+  where a location holding any available copy has the status "Available"."""
+  data = {"hoopla": False, "holdings": {}}
+  soup = BeautifulSoup(html, PARSER, parse_only=RESULTS)
+  for el in soup.find_all("div", class_="searchResult"):
+    item_type = el.select("div.recordDetailValue > span.itemMediaDescription")[0].string.strip()
+    if item_type == "EBOOK":
+      if "at Hoopla" in el.stripped_strings:
+        data["hoopla"] = True
+        for additional_info in el.select("div.addtlInfo > a"):
+          if "Instantly available on hoopla." in additional_info.stripped_strings:
+            data["hoopla"] = additional_info["href"]
+            break
+    elif item_type == "BOOK":
+      for table in el.select("div.bibHoldingsWrapper table.itemTable"):
+        for row in table("tr"):
+          tds = list(row("td"))
+          if len(tds) < 3:
+            continue
+          location = tds[0].get_text(strip=True)
+          status = tds[2].get_text(strip=True)
+          if data["holdings"].get(location) != "Available":
+            data["holdings"][location] = status
+  return data
+
+
+def parse(html):
+  """parse_results, in this thread if it's free, or else in the process pool."""
+  global pool, in_flight, use_pool
+  with lock:
+    inline = not use_pool or in_flight < INLINE_PARSES or POOL_SIZE < 2
+    if inline:
+      in_flight += 1
+    elif pool is None:
+      # Forking while the lookup threads hold locks could deadlock the children, so
+      # they start fresh and only import this module.
+      pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=POOL_SIZE, mp_context=multiprocessing.get_context("spawn"))
+  if not inline:
+    try:
+      return pool.submit(parse_results, html).result()
+    # Including BrokenProcessPool, which is a RuntimeError.
+    except (RuntimeError, OSError) as e:
+      sys.stderr.write("Parsing Encore pages in this process from now on: {}\n".format(e))
+      with lock:
+        use_pool = False
+      return parse_results(html)
+  try:
+    return parse_results(html)
+  finally:
+    with lock:
+      in_flight -= 1
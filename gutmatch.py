@@ -0,0 +1,140 @@
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Match a book against the Gutenberg catalog, allowing for how differently it's written.
+
+Goodreads and Gutenberg often write the same book differently: "The Blazing World" is
+"Description of a New World, Called the Blazing-World", and "Crime and Punishment" is
+by Fyodor Dostoyevsky rather than Dostoevsky. So titles and authors are compared as
+sets of letter trigrams, after folding case, accents and punctuation and dropping a
+leading article. A title also counts as what comes before its first colon or semicolon,
+which is usually the subtitle.
+
+The candidates are the records with one of the book's title words, found in the
+catalog's word index, so a lookup only reads a few records. A title's score is mostly
+how much of the book's title is in the record's, with a little for how close they are
+overall, so "Dracula" prefers "Dracula" to "Dracula's Guest". A record matches if its
+title scores at least TITLE_THRESHOLD and the book's author's surname is in its
+author, allowing for spelling variants. The book gets its best scoring record, or the
+earliest one in the catalog on a tie.
+"""
+
+import functools
+import re
+import unicodedata
+
+
+TITLE_THRESHOLD = 0.8
+AUTHOR_THRESHOLD = 0.7
+# How much of a title's score is for the overall overlap, rather than containment.
+JACCARD_WEIGHT = 0.15
+
+ARTICLES = ("the", "a", "an")
+# Too common to find candidates by.
+STOP_WORDS = frozenset(ARTICLES + ("of", "and", "in", "to", "or", "on", "by", "for", "with",
+                                   "at", "from"))
+SUBTITLE = re.compile(r"[:;(]")
+WORD = re.compile(r"[a-z0-9]+")
+
+
+def fold(text):
+  """Lowercase words, without accents or punctuation."""
+  text = (text or "").lower()
+  if not text.isascii():
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c)).replace("’", "")
+  return WORD.findall(text.replace("&", " and ").replace("'", ""))
+
+
+def title_words(title):
+  words = fold(title)
+  if len(words) > 1 and words[0] in ARTICLES:
+    words = words[1:]
+  return words
+
+
+def trigrams(words):
+  """The trigrams of each word, padded with a space at each end."""
+  grams = set()
+  for word in words:
+    padded = " {} ".format(word)
+    grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+  return grams
+
+
+def title_signatures(title, words=None):
+  """Trigram sets for the whole title, and for the part before any subtitle."""
+  variants = [title_words(title) if words is None else words]
+  main = SUBTITLE.split(title or "", 1)[0]
+  if main != title:
+    variants.append(title_words(main))
+  return [trigrams(words) for words in variants if words]
+
+
+# Most authors have many records, so each is only folded once in a while.
+@functools.lru_cache(maxsize=4096)
+def author_signature(author):
+  """The words of an author, and their trigrams."""
+  words = fold(author)
+  return frozenset(words), frozenset(trigrams(words))
+
+
+def title_score(book_signatures, record_signatures):
+  best = 0.0
+  for book in book_signatures:
+    for record in record_signatures:
+      shared = len(book & record)
+      if shared:
+        score = ((1 - JACCARD_WEIGHT) * shared / len(book)
+                 + JACCARD_WEIGHT * shared / len(book | record))
+        best = max(best, score)
+  return best
+
+
+class Book:
+  """A book to match, normalized once."""
+
+  def __init__(self, title, author):
+    self.signatures = title_signatures(title)
+    self.words = set(title_words(title))
+    names = fold(author)
+    self.surname_word = names[-1] if names else None
+    self.surname = trigrams(names[-1:])
+
+  def score(self, title, author):
+    """How well a record's title matches, or 0 if its author doesn't."""
+    # The surname has to be in the record's author, or something spelled like it.
+    if self.surname_word:
+      author_words, author_trigrams = author_signature(author)
+      if (self.surname_word not in author_words
+          and len(self.surname & author_trigrams) < AUTHOR_THRESHOLD * len(self.surname)):
+        return 0
+    return title_score(self.signatures, title_signatures(title))
+
+
+def lookup(gutindex, title, author):
+  """Return the best matching (title, author, ebook number) record in a catalog.py
+  catalog, or None. title shouldn't have the series in it."""
+  book = Book(title, author)
+  candidates = set()
+  for word in book.words - STOP_WORDS or book.words:
+    candidates.update(gutindex.word_postings(word))
+  best = None
+  for i in sorted(candidates):
+    record = gutindex.record(i)
+    score = book.score(record[0], record[1])
+    if score >= TITLE_THRESHOLD and (best is None or score > best[1]):
+      best = (record, score)
+  return best[0] if best else None
@@ -0,0 +1,227 @@
+#! /usr/bin/env python3
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Background lookup jobs, so a big list doesn't have to fit in one Web request.
+
+find.cgi submits a list of books, which starts this script as a separate worker
+process and returns a job ID straight away. The worker writes its progress and each
+available book to the job's directory as it goes, and find.cgi reads them back to show
+whatever has been found so far.
+
+Each job is a directory under JOBS_DIR holding:
+
+  input.json      the books, Overdrive subdomains and limit to look up
+  status.json     state ("queued", "running", "done" or "error"), done and total counts
+  results.ndjson  one line per available book, in list order
+  worker.log      the worker's progress and errors
+
+At most MAX_RUNNING workers look books up at once, and the rest wait their turn. No
+more than MAX_PENDING jobs can be waiting or running, and submitting another raises
+Busy. Jobs are deleted JOB_TTL seconds after they were last updated.
+
+Usage: jobs.py run JOB_ID
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import re
+import secrets
+import shutil
+import subprocess
+import sys
+import time
+import util
+
+
+JOBS_DIR = os.environ.get("LIBRARY_JOBS", "/tmp/library_jobs")
+JOB_ID = re.compile(r"^[0-9a-f]{16}$")
+MAX_RUNNING = 2
+MAX_PENDING = 8
+JOB_TTL = 24 * 60 * 60
+# A running job that hasn't finished a book for this long has probably died.
+STALLED = 15 * 60
+# How often a waiting worker checks for a free slot.
+SLOT_POLL = 1
+
+
+class NoSuchJob(Exception):
+  pass
+
+
+class Busy(Exception):
+  pass
+
+
+def job_dir(job_id):
+  if not JOB_ID.match(job_id or ""):
+    raise NoSuchJob(job_id)
+  path = os.path.join(JOBS_DIR, job_id)
+  if not os.path.isdir(path):
+    raise NoSuchJob(job_id)
+  return path
+
+
+def write_status(path, status):
+  """Replace status.json in one step, so a poll never reads half of it."""
+  util.write_atomically(os.path.join(path, "status.json"), lambda f: json.dump(status, f))
+
+
+def job_dirs():
+  """Yield (path, seconds since its status changed, state) for each job."""
+  try:
+    names = os.listdir(JOBS_DIR)
+  except FileNotFoundError:
+    return
+  for name in names:
+    path = os.path.join(JOBS_DIR, name)
+    if not JOB_ID.match(name) or not os.path.isdir(path):
+      continue
+    try:
+      status_path = os.path.join(path, "status.json")
+      age = time.time() - os.path.getmtime(status_path)
+      with open(status_path) as f:
+        state = json.load(f)["state"]
+    except (OSError, ValueError, KeyError):
+      # Not written yet, or left broken by a worker that died.
+      age = time.time() - os.path.getmtime(path)
+      state = None
+    yield path, age, state
+
+
+def expire():
+  """Delete the jobs that haven't changed for JOB_TTL, and return how many are left
+  waiting or running."""
+  pending = 0
+  for path, age, state in job_dirs():
+    if age > JOB_TTL:
+      shutil.rmtree(path, ignore_errors=True)
+    elif state == "queued" or (state == "running" and age < STALLED):
+      pending += 1
+  return pending
+
+
+@contextlib.contextmanager
+def slot():
+  """Wait for one of the MAX_RUNNING worker slots, and hold it."""
+  os.makedirs(JOBS_DIR, exist_ok=True)
+  while True:
+    for n in range(MAX_RUNNING):
+      f = open(os.path.join(JOBS_DIR, "slot-{}.lock".format(n)), "a")
+      try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        f.close()
+        continue
+      with f:
+        yield
+      return
+    time.sleep(SLOT_POLL)
+
+
+def submit(books, overdrive_subdomains=None, limit=None, history=None):
+  """Start looking up (title, author) pairs in a worker process, and return the job ID.
+
+  Without overdrive_subdomains, the worker uses library.OVERDRIVE_SUBDOMAINS. With a
+  limit, it stops once that many books are available, after sorting the books as
+  library.prioritize does with the books available in history.
+
+  Raises Busy if MAX_PENDING jobs are already waiting or running."""
+  if expire() >= MAX_PENDING:
+    raise Busy("Too many searches are running. Try again in a few minutes.")
+  job_id = secrets.token_hex(8)
+  path = os.path.join(JOBS_DIR, job_id)
+  os.makedirs(path)
+  with open(os.path.join(path, "input.json"), "w") as f:
+    json.dump({"books": books,
+               "overdrive": list(overdrive_subdomains) if overdrive_subdomains else None,
+               "limit": limit,
+               "history": history and os.path.abspath(history)}, f)
+  open(os.path.join(path, "results.ndjson"), "w").close()
+  write_status(path, {"state": "queued", "done": 0, "total": len(books), "started": time.time()})
+  with open(os.path.join(path, "worker.log"), "w") as log:
+    # The worker mustn't hold on to the CGI's output, or the Web server would wait for it.
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), "run", job_id],
+                     stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+                     start_new_session=True)
+  return job_id
+
+
+def run(job_id):
+  """Look up a job's books, recording progress after each one."""
+  import library
+
+  # The worker is a fresh process too, so it leaves the lookups to daemon.py if it can.
+  library.use_daemon = True
+  path = job_dir(job_id)
+  with open(os.path.join(path, "input.json")) as f:
+    job = json.load(f)
+  books = [tuple(book) for book in job["books"]]
+  limit = job.get("limit")
+  if limit:
+    books = library.prioritize(books, library.recently_available(job.get("history")))
+  status = {"state": "running", "done": 0, "total": len(books), "started": time.time()}
+  found = 0
+  try:
+    with slot():
+      write_status(path, status)
+      lookups = library.find_books(books, job["overdrive"] or library.OVERDRIVE_SUBDOMAINS)
+      with open(os.path.join(path, "results.ndjson"), "a") as results, \
+           contextlib.closing(lookups):
+        for book in lookups:
+          if library.found_book(book):
+            results.write(json.dumps(book) + "\n")
+            results.flush()
+            found += 1
+          status["done"] += 1
+          write_status(path, status)
+          if limit and found >= limit:
+            break
+  except Exception as e:
+    status["state"] = "error"
+    status["error"] = str(e)
+    write_status(path, status)
+    raise
+  status["state"] = "done"
+  status["finished"] = time.time()
+  write_status(path, status)
+
+
+def status(job_id):
+  """Return the job's status, with the available books found so far as "books"."""
+  path = job_dir(job_id)
+  with open(os.path.join(path, "status.json")) as f:
+    job_status = json.load(f)
+  books = []
+  with open(os.path.join(path, "results.ndjson")) as f:
+    for line in f:
+      # The worker may be in the middle of writing the last line.
+      if line.endswith("\n"):
+        books.append(json.loads(line))
+  job_status["books"] = books
+  return job_status
+
+
+def main(argv):
+  if len(argv) != 3 or argv[1] != "run":
+    print(__doc__.strip().split("\n")[-1])
+    exit(1)
+  run(argv[2])
+
+
+if __name__ == "__main__":
+  main(sys.argv)
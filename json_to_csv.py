@@ -14,40 +14,218 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+"""Write the given columns of lists of books as CSV.
+
+The input is library.py's output, as a JSON list or one book per line, read a piece at
+a time and written out as it goes. It can also be many files: a history directory like
+cron.sh's, or a glob. Those are read in the order of the dates in their names, and
+.delta.json files from --delta are replayed onto the list before them, so each file
+stands for the books available on its date.
+
+--snapshot-date adds each row's file date as a snapshot_date column. --seen writes one
+row per book instead, from its last listing, with first_seen and last_seen columns.
+Only the books available at the time, and with --seen each book's dates, are held in
+memory, however long the history is.
+
+Usage: json_to_csv.py [--input PATH]... [--snapshot-date | --seen] col1 col2 col3
+"""
+
+import argparse
 import csv
-import io
+import datetime
+import glob
 import json
+import os
+import re
 import sys
 
 
-def convert_to_csv(colnames, f):
-  s = io.StringIO()
+CHUNK = 1 << 16
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+# As written by date -Iminutes, in cron.sh's history file names.
+FILE_DATE = re.compile(r"\d{4}-\d{2}-\d{2}T[0-9:+-]+")
 
-  writer = csv.writer(s)
 
-  writer.writerow(colnames)
+class Reader:
+  """JSON values from a file, read a chunk at a time."""
+
+  def __init__(self, f):
+    self.f = f
+    self.buffer = ""
+    self.pos = 0
+    self.eof = False
+    self.decoder = json.JSONDecoder()
+
+  def fill(self):
+    """Read another chunk, returning False at the end of the file."""
+    chunk = self.f.read(CHUNK)
+    if not chunk:
+      self.eof = True
+      return False
+    self.buffer = self.buffer[self.pos:] + chunk
+    self.pos = 0
+    return True
+
+  def peek(self):
+    """Skip whitespace, and return the next character, or "" at the end."""
+    while True:
+      pos = self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+      if pos < len(self.buffer) or not self.fill():
+        return self.buffer[pos:pos + 1]
+
+  def value(self):
+    while True:
+      start = WHITESPACE.match(self.buffer, self.pos).end()
+      try:
+        value, end = self.decoder.raw_decode(self.buffer, start)
+      except json.JSONDecodeError:
+        # Probably cut off at the end of the chunk.
+        if not self.fill():
+          raise
+        continue
+      # A number might go on in the next chunk.
+      if end == len(self.buffer) and not self.eof and self.fill():
+        continue
+      self.pos = end
+      return value
+
+
+def read_json(f):
+  """Yield the elements of a JSON list, or each value in a file of them, such as one
+  book per line."""
+  reader = Reader(f)
+  if reader.peek() != "[":
+    while reader.peek():
+      yield reader.value()
+    return
+  reader.pos += 1
+  if reader.peek() == "]":
+    return
+  while True:
+    yield reader.value()
+    separator = reader.peek()
+    reader.pos += 1
+    if separator == "]":
+      return
+    if separator != ",":
+      raise ValueError("Expected , or ] in the list, not {!r}".format(separator))
+
+
+def book_key(book):
+  return "{}\x1f{}".format(book.get("title"), book.get("author") or "")
 
-  for el in json.load(f):
-    line = []
-    for col in colnames:
-      if col in el:
-        line.append(str(el[col]))
-      else:
-        line.append("")
-    writer.writerow(line)
 
-  return s.getvalue()
+def is_delta(value):
+  return isinstance(value, dict) and ("added" in value or "removed" in value)
 
 
-def usage(name):
-  print("Usage: {} col1 col2 col3 < file.json".format(name))
+def file_date(path):
+  """The date in a file's name, or else when it was last changed."""
+  match = FILE_DATE.search(os.path.basename(path))
+  if match:
+    return match.group(0)
+  mtime = os.path.getmtime(path)
+  return datetime.datetime.fromtimestamp(mtime).astimezone().isoformat(timespec="minutes")
+
+
+def input_paths(patterns):
+  """The files named by each pattern, which can be a file, a directory of .json files,
+  or a glob, in date order."""
+  paths = []
+  for pattern in patterns:
+    if os.path.isdir(pattern):
+      paths.extend(glob.glob(os.path.join(pattern, "*.json")))
+    elif os.path.exists(pattern):
+      paths.append(pattern)
+    else:
+      matched = glob.glob(pattern)
+      if not matched:
+        sys.stderr.write("No files match {}\n".format(pattern))
+      paths.extend(path for path in matched if not os.path.isdir(path))
+  return sorted(paths, key=file_date)
+
+
+def snapshots(paths):
+  """Yield (date, books) for each file, where books iterates over the books available
+  on that date. Each must be used up before the next file is read."""
+  available = {}
+  for path in paths:
+    with open(path) as f:
+      values = read_json(f)
+      first = next(values, None)
+      if is_delta(first):
+        for book in first.get("removed", []):
+          available.pop(book_key(book), None)
+        for book in first.get("added", []):
+          available[book_key(book)] = book
+        yield file_date(path), iter(list(available.values()))
+        continue
+      available = {}
+
+      def books():
+        if first is None:
+          return
+        available[book_key(first)] = first
+        yield first
+        for book in values:
+          available[book_key(book)] = book
+          yield book
+      yield file_date(path), books()
+
+
+def row(colnames, book):
+  return [str(book[col]) if col in book else "" for col in colnames]
+
+
+def convert_to_csv(colnames, books, out):
+  """Write a header and the books as CSV rows to out."""
+  writer = csv.writer(out)
+  writer.writerow(colnames)
+  for book in books:
+    writer.writerow(row(colnames, book))
+
+
+def convert_history(colnames, paths, out, snapshot_date=False, seen=False):
+  """Write the books in each file as CSV rows, with the extra columns asked for."""
+  writer = csv.writer(out)
+  if seen:
+    writer.writerow(colnames + ["first_seen", "last_seen"])
+    # Each book's last listing, and the dates it was first and last seen.
+    books = {}
+    for date, available in snapshots(paths):
+      for book in available:
+        key = book_key(book)
+        books[key] = (book, books[key][1] if key in books else date, date)
+    for book, first_seen, last_seen in books.values():
+      writer.writerow(row(colnames, book) + [first_seen, last_seen])
+    return
+  writer.writerow(colnames + ["snapshot_date"] if snapshot_date else colnames)
+  for date, available in snapshots(paths):
+    for book in available:
+      writer.writerow(row(colnames, book) + [date] if snapshot_date else row(colnames, book))
 
 
 def main(argv):
-  if len(argv) < 2:
-    usage(argv[0])
-    exit(1)
-  print(convert_to_csv(argv[1:], sys.stdin), end="")
+  parser = argparse.ArgumentParser(prog=argv[0], description=__doc__.split("\n\n")[0])
+  parser.add_argument("columns", nargs="+", metavar="column",
+                      help="a book field to write, such as title or author")
+  parser.add_argument("--input", "-i", action="append", default=[], metavar="PATH",
+                      help="a file, a directory of .json files or a glob to read, instead "
+                      "of standard input (can be repeated)")
+  extra = parser.add_mutually_exclusive_group()
+  extra.add_argument("--snapshot-date", action="store_true",
+                     help="add the date of each book's file as a snapshot_date column")
+  extra.add_argument("--seen", action="store_true",
+                     help="write each book once, with first_seen and last_seen columns")
+  args = parser.parse_args(argv[1:])
+
+  if not args.input and not args.snapshot_date and not args.seen:
+    convert_to_csv(args.columns, read_json(sys.stdin), sys.stdout)
+    return
+  if not args.input:
+    parser.error("--snapshot-date and --seen need --input")
+  convert_history(args.columns, input_paths(args.input), sys.stdout,
+                  args.snapshot_date, args.seen)
 
 
 if __name__ == "__main__":
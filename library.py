@@ -39,41 +39,66 @@ different ways. This program does the best it can, using what details we know ab
 each service works.
 """
 
-from bs4 import BeautifulSoup
+import argparse
 import bz2
+import cache
+import catalog
+import concurrent.futures
+import contextlib
 import csv
+import daemon
+import encore
+import functools
+import gutmatch
 import json
+import mediaitems
+import olindex
 import os
 import pickle
 import re
 import requests
+import scheduler
+import shelves
+import stats
 import sys
+import threading
+import throttle
+import time
+import transport
 import urllib.parse
+import util
+from shelves import book_key, extract_title
 
 
 OVERDRIVE_SUBDOMAINS = ("minuteman", "bpl")
 
-GOODREADS_SERIES_REGEX = re.compile(r'(.+)\(([^\)]*), [#](\d+)\)')
+# Minuteman branches to look for physical copies in, as the catalog names their shelves.
+MINUTEMAN_BRANCHES = ("SOMERVILLE/EAST",)
 
-def extract_title(title):
-  """Parse a title that is part of a series as displayed by Goodreads."""
-  regex = GOODREADS_SERIES_REGEX.match(title)
-  if regex:
-    return {"title": regex.group(1).strip(),
-            "series": regex.group(2),
-            "number": regex.group(3)}
-  return {"title": title,
-          "series": None,
-          "number": None}
+# How many books to look up at once. Each host is also rate limited by throttle.py.
+WORKERS = 4
 
+# With --incremental, how long to wait before checking an unavailable book again.
+RECHECK_AFTER = 3 * 24 * 60 * 60
+
+# Where each provider is. These can be changed from the environment, to point at a
+# stand-in server like benchmarks/replay_server.py.
+OVERDRIVE_URL = os.environ.get("LIBRARY_OVERDRIVE_URL", "https://{subdomain}.overdrive.com")
+MINUTEMAN_URL = os.environ.get("LIBRARY_MINUTEMAN_URL", "https://find.minlib.net")
+OPEN_LIBRARY_URL = os.environ.get("LIBRARY_OPEN_LIBRARY_URL", "https://openlibrary.org")
+GUTINDEX_URL = os.environ.get("LIBRARY_GUTINDEX_URL",
+                              "https://www.gutenberg.org/dirs/GUTINDEX.ALL")
 
 # Project Gutenberg has a ~8MB text file listing its catalog. There are a lot of
 # transcription errors, and just variations in titles, so some extra logic goes into
 # looking for matches.
 
 
-GUTINDEX_URL = "https://www.gutenberg.org/dirs/GUTINDEX.ALL"
+GUTINDEX_PATH = "/tmp/gutindex.cat"
+GUTINDEX_META_PATH = "/tmp/gutindex.json"
+LEGACY_GUTINDEX_PATH = "/tmp/gutindex.pkl"
 gutindex = None
+gutindex_lock = threading.Lock()
 
 MAIN_LINE = re.compile(r'(.*)\s+([0-9]+C?)\s*$')
 
@@ -106,7 +131,7 @@ def process_gutenberg(parts):
 
 def split_title(title):
   """Splits a title, or title and author, into individual words, probably."""
-  return re.split(r'[-\s,:;\(\)]', title)
+  return catalog.WORD_SEPARATORS.split(title)
 
 
 def gutenberg_match(work, title, author):
@@ -123,52 +148,51 @@ def gutenberg_match(work, title, author):
 
 
 def gutenberg_lookup(gutindex, title, author):
-  """Filter catalog to find likely matches, and if there's only one, return it."""
-  works = list(gutindex.keys())
-  for word in split_title(" ".join([title, author or ""])):
-    filtered_works = []
-    for work in works:
-      if word.lower() in work[0] or word.lower() in (work[1] or []):
-        filtered_works.append(work)
-    if len(filtered_works) == 0:
-      return None
-    elif len(filtered_works) == 1:
-      return gutenberg_match(filtered_works[0], title, author)
-    works = filtered_works
-  return filtered_works[0]  # Giving up, giving "most likely" of last set
+  """Filter catalog to find likely matches, and if there's only one, return it.
 
+  This is the old word-by-word match, which gutmatch.lookup replaced for finding books.
+  benchmarks/bench_gutmatch.py still compares the two.
 
-def gutenberg(title, author):
-  """Download Project Gutenberg catalog and process it, then return the likely record, if any."""
-  global gutindex
-  if gutindex:
-    book = gutenberg_lookup(gutindex, title, author)
-    if book:
-      return book + (gutindex[book],)
-    else:
+  Every word of the title and author has to appear in a record's title or author.
+  Start from the word with the fewest records in the index, then check the remaining
+  words against only those records."""
+  words = []
+  for word in split_title(" ".join([title, author or ""])):
+    word = word.lower()
+    if word and word not in words:
+      words.append(word)
+  if not words:
+    return gutindex.record(0)
+  sized = []
+  for word in words:
+    postings = gutindex.postings(word)
+    sized.append((sum(len(posting) for posting in postings), word, postings))
+  sized.sort(key=lambda s: s[0])
+  if sized[0][0] == 0:
+    return None
+  candidates = set()
+  for posting in sized[0][2]:
+    candidates.update(posting)
+  works = {i: gutindex.record(i) for i in candidates}
+  for _, word, _ in sized[1:]:
+    works = {i: work for i, work in works.items()
+             if word in work[0] or word in (work[1] or "")}
+    if not works:
       return None
+  if len(works) == 1:
+    return gutenberg_match(works.popitem()[1], title, author)
+  return works[min(works)]  # Giving up, giving "most likely" of what's left
+
 
-  if os.path.exists("/tmp/gutindex.pkl"):
-    gutindex = pickle.load(open("/tmp/gutindex.pkl", "rb"))
-    return gutenberg(title, author)
+def parse_gutenberg(lines):
+  """Yield (title, author, ebook number) records from the lines of GUTINDEX.ALL.
 
-  line_count = 0
-  gutindex = {}
+  This works line by line, so the catalog can be parsed as it is downloaded, and the
+  caller can stop reading as soon as it has the records it wants."""
   state = None
   ebook_no = None
   parts = []
-  r = requests.get(GUTINDEX_URL)
-  try:
-    r.raise_for_status()
-  except requests.exceptions.HTTPError as e:
-    gutindex = "not found"
-    raise e
-  r.encoding = "UTF-8"
-  with open("/tmp/gutindex.txt", "w") as f:
-    f.write(r.text)
-  for bytesline in r.iter_lines():
-    line = bytesline.decode("utf8")
-    line_count += 1
+  for line in lines:
     if state == None:
       if line.strip() == "<==LISTINGS==>":
         state = "listings"
@@ -189,7 +213,7 @@ def gutenberg(title, author):
             book_author = None
             if len(processed) > 1:
               book_author = processed[1]
-            gutindex[(book_title, book_author)] = ebook_no
+            yield (book_title, book_author, ebook_no)
 
         if line.strip() == "<==End of GUTINDEX.ALL==>":
           break
@@ -215,8 +239,121 @@ def gutenberg(title, author):
           if line.strip() == "What Have the Greeks Done, by":
             continue
           parts.append(line.strip())
-  pickle.dump(gutindex, open("/tmp/gutindex.pkl", "wb"))
-  return gutenberg(title, author)
+
+
+def refresh_gutenberg(source=GUTINDEX_URL, full=False):
+  """Bring the saved Gutenberg catalog up to date, returning how many records were added.
+
+  The catalog is listed newest first, so unless a full rebuild is asked for, reading
+  stops at the first ebook number that was already in the last build, and only the
+  records before it are parsed and merged in. The URL is fetched with the validators
+  from the last build, so if it hasn't changed the server just answers 304.
+
+  source can also be a local copy of GUTINDEX.ALL, which is checked by its size and
+  modification time instead."""
+  global gutindex
+  meta = {}
+  if not full and os.path.exists(GUTINDEX_PATH) and os.path.exists(GUTINDEX_META_PATH):
+    with open(GUTINDEX_META_PATH) as f:
+      meta = json.load(f)
+  if meta.get("source") != source or not readable_catalog(GUTINDEX_PATH):
+    meta = {"source": source}
+  newest = meta.get("newest", 0)
+
+  with contextlib.ExitStack() as stack:
+    if source.startswith("http://") or source.startswith("https://"):
+      headers = {}
+      if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+      if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+      r = stack.enter_context(transport.get(source, headers=headers, stream=True))
+      if r.status_code == 304:
+        return 0
+      r.raise_for_status()
+      meta["etag"] = r.headers.get("ETag")
+      meta["last_modified"] = r.headers.get("Last-Modified")
+      lines = (line.decode("utf8") for line in r.iter_lines())
+    else:
+      stat = os.stat(source)
+      etag = "{}-{}".format(stat.st_size, stat.st_mtime_ns)
+      if meta.get("etag") == etag:
+        return 0
+      meta["etag"] = etag
+      f = stack.enter_context(open(source, encoding="utf8"))
+      lines = (line.rstrip("\r\n") for line in f)
+
+    added = []
+    for record in parse_gutenberg(lines):
+      if int(record[2]) <= newest:
+        break
+      added.append(record)
+
+  if added or not os.path.exists(GUTINDEX_PATH):
+    merged = {}
+    for book_title, book_author, ebook_no in added:
+      merged[(book_title, book_author)] = ebook_no
+    if newest:
+      for book_title, book_author, ebook_no in catalog.Catalog(GUTINDEX_PATH):
+        merged[(book_title, book_author)] = ebook_no
+    catalog.write(GUTINDEX_PATH, (book + (ebook_no,) for book, ebook_no in merged.items()))
+    gutindex = None
+  meta["newest"] = max([newest] + [int(record[2]) for record in added])
+  with open(GUTINDEX_META_PATH, "w") as f:
+    json.dump(meta, f)
+  return len(added)
+
+
+def readable_catalog(path):
+  """Whether there's a catalog at path that this version can read."""
+  try:
+    catalog.Catalog(path).close()
+    return True
+  except FileNotFoundError:
+    return False
+  except (OSError, ValueError, catalog.CatalogError) as e:
+    sys.stderr.write("Rebuilding the Gutenberg catalog: {}\n".format(e))
+    return False
+
+
+def load_gutenberg():
+  """Open the saved catalog, building it first if there isn't one, or it was written
+  by an older version."""
+  global gutindex
+  if readable_catalog(GUTINDEX_PATH):
+    gutindex = catalog.Catalog(GUTINDEX_PATH)
+    return
+
+  if os.path.exists(LEGACY_GUTINDEX_PATH):
+    legacy = pickle.load(open(LEGACY_GUTINDEX_PATH, "rb"))
+    catalog.write(GUTINDEX_PATH, (book + (ebook_no,) for book, ebook_no in legacy.items()))
+    return load_gutenberg()
+
+  try:
+    refresh_gutenberg(full=True)
+  except requests.exceptions.RequestException as e:
+    gutindex = "not found"
+    raise e
+  return load_gutenberg()
+
+
+@stats.timed("gutenberg")
+def open_gutindex():
+  """Download Project Gutenberg catalog and process it, if that hasn't been done yet."""
+  if gutindex is None:
+    # Only one thread should download and build the catalog.
+    with gutindex_lock:
+      if gutindex is None:
+        with stats.phase("gutenberg_load"):
+          load_gutenberg()
+
+
+def gutenberg(title, author):
+  """Return the likely Project Gutenberg record, if any."""
+  open_gutindex()
+  if gutindex == "not found":
+    return None
+  return gutmatch.lookup(gutindex, title, author)
 
 
 # Overdrive has separate URLs for each library, but doesn't need a login to report
@@ -229,34 +366,32 @@ def overdrive_title(title_parts):
   return title_parts["title"]
 
 
+# Copies get checked out and returned all the time, so this is kept short.
+@stats.timed("overdrive")
+@cache.cached("overdrive", positive_ttl=12 * cache.HOUR, negative_ttl=2 * cache.DAY,
+              found=lambda data: data["available"])
 def overdrive(subdomain, title, author):
   """Parse Overdrive to find books that are available.
 
   Overdrive won't let me use their API, and the HTML is generated dynamically by JS.
   But, first, the data is loaded as a JSON blob inserted into the page. So, we can
   parse that."""
-  r = requests.get("https://{}.overdrive.com/search".format(subdomain),
-                   params={"query": title,
-                           "creator": author,
-                           "sortBy": "relevance"})
-  r.raise_for_status()
+  url = OVERDRIVE_URL.format(subdomain=subdomain) + "/search"
+  r = transport.get(url,
+                    params={"query": title,
+                            "creator": author,
+                            "sortBy": "relevance"},
+                    stream=True)
+  # Closing the response once the books have been read skips the rest of the page.
+  with contextlib.closing(r):
+    r.raise_for_status()
+    media_items = mediaitems.media_items(r.iter_content(mediaitems.CHUNK_SIZE))
   data = {"available": False}
-  # This is the start of the line where the JSON blobs reside.
-  match = "window.OverDrive.mediaItems = "
-  start = r.text.find(match)
-  if start == -1:
-    return data
-  decoder = json.JSONDecoder()
-  # This should read just one JSON object from the select spot in the text.
-  # Since it stops after one object, we don't have to worry about otherwise detecting
-  # the end of the JSON blob.
-  media_items = decoder.raw_decode(r.text[start + len(match):])[0]
-  for key in media_items:
-    item = media_items[key]
-    if item["title"] == title and item["type"]["name"] == "eBook" and item["isAvailable"]:
+  for key, item in (media_items or {}).items():
+    if item["title"] == title and item["type"] == "eBook" and item["isAvailable"]:
       data["available"] = True
       # This URL redirects to a specific one for your library if you are logged in.
-      data["url"] = "https://{}.overdrive.com/media/{}".format(subdomain, key)
+      data["url"] = "{}/media/{}".format(OVERDRIVE_URL.format(subdomain=subdomain), key)
       break
   return data
 
@@ -274,82 +409,92 @@ def mln_title(title_parts):
   return title_parts["title"]
 
 
-def minuteman(title, author):
-  """Read from Minuteman to extract Hoopla availability.
+# Advanced search filters that narrow a search to one branch's printed books, from
+# https://find.minlib.net/iii/encore/home?lang=eng&suite=cobalt&advancedSearch=true with
+# format BOOK, location Somerville and collection SOMERVILLE/EAST. Other branches are
+# only narrowed to printed books.
+BRANCH_FILTERS = {"SOMERVILLE/EAST": "f:a c:32 b:so2"}
+BOOK_FILTER = "f:a"
+
+
+@cache.per_run
+def minuteman_search(title, author, filters):
+  """Search Minuteman, reading both Hoopla availability and physical copies.
 
   Minuteman is nice enough to have a "Availble at Hoopla" annotation on the book results,
-  so we can read that."""
-  data = {"hoopla": False}
-  query_str = urllib.parse.quote("C__St:({title}) a:({author})__Orightresult__U".format(
-    title=title,
-    author=author))
-  try:
-    r = requests.get("https://find.minlib.net/iii/encore/search/" + query_str,
-                     params={"lang": "eng", "suite": "cobalt", "fromMain": "yes"})
-  except requests.exceptions.ConnectionError:
-    return data
+  so we can read that. Printed books have a table of which branches hold them.
+
+  Returns {"hoopla": False, True or a link to the book, "holdings": {location: status}},
+  where a location holding any available copy has the status "Available". The result is
+  shared by everything that asks about the same book, with the same filters, during a
+  run, so filters is always given, as "" for none. minuteman() uses the unfiltered
+  search, and minuteman_holdings() reads it too before narrowing to a branch, so a book
+  that is on the shelf only costs one search for both."""
+  query = "C__St:({title}) a:({author})".format(title=title, author=author)
+  if filters:
+    query += " " + filters
+  query_str = urllib.parse.quote(query + "__Orightresult__U")
+  url = MINUTEMAN_URL + "/iii/encore/search/" + query_str
+  r = transport.get(url,
+                    params={"lang": "eng", "suite": "cobalt", "fromMain": "yes"})
   r.raise_for_status()
-  soup = BeautifulSoup(r.text, "html.parser")
-  for el in soup.find_all("div", class_="searchResult"):
-    item_type = el.select("div.recordDetailValue > span.itemMediaDescription")[0].string.strip()
-    if item_type == "EBOOK":
-      if "at Hoopla" in el.stripped_strings:
-        data["hoopla"] = True
-        for additional_info in el.select("div.addtlInfo > a"):
-          if "Instantly available on hoopla." in additional_info.stripped_strings:
-            data["hoopla"] = additional_info["href"]
-            break
+  return encore.parse(r.content)
+
+
+# Being on Hoopla rarely changes, so not being there is remembered longer.
+@stats.timed("minuteman")
+@cache.cached("minuteman", positive_ttl=2 * cache.DAY, negative_ttl=7 * cache.DAY,
+              found=lambda data: data["hoopla"])
+def minuteman(title, author):
+  """Read from Minuteman to extract Hoopla availability."""
+  return {"hoopla": minuteman_search(title, author, "")["hoopla"]}
+
+
+@stats.timed("minuteman_holdings")
+@cache.cached("minuteman_holdings", positive_ttl=12 * cache.HOUR, negative_ttl=2 * cache.DAY,
+              found=lambda data: any(data.values()))
+def minuteman_holdings(title, author, branches=MINUTEMAN_BRANCHES):
+  """Look for physical books available in Minuteman branches.
+
+  Returns a dict from each lowercased branch name to "Available" or False. The
+  unfiltered search, which minuteman() shares, is read first. The first page of it can
+  leave out a branch's copies, though, so a branch with no available copy there gets
+  its own search, narrowed by BRANCH_FILTERS, which costs a second request. Locations
+  are matched by prefix, so "SOMERVILLE/EAST" covers all of that branch's shelves. As
+  before, a copy of any printed edition found counts."""
+  data = {}
+  for branch in branches:
+    data[branch.lower()] = False
+    for filters in ("", BRANCH_FILTERS.get(branch, BOOK_FILTER)):
+      holdings = minuteman_search(title, author, filters)["holdings"]
+      if any(location.startswith(branch) and status == "Available"
+             for location, status in holdings.items()):
+        data[branch.lower()] = "Available"
+        break
   return data
 
 
 def somervilleeast(title, author):
   """Look for physical books available in the Somerville Library East branch."""
-  # This query string was derived from an advantaced search at https://find.minlib.net/iii/encore/home?lang=eng&suite=cobalt&advancedSearch=true
-  # with a title and author, with format BOOK, location Somerville, collection SOMERVILLE/EAST
-  query_str = urllib.parse.quote("C__St:({title}) a:({author}) f:a c:32 b:so2__Orightresult__U".format(
-    title=title,
-    author=author))
-  r = requests.get("https://find.minlib.net/iii/encore/search/" + query_str,
-                   params={"lang": "eng", "suite": "cobalt", "fromMain": "yes"})
-  r.raise_for_status()
-  soup = BeautifulSoup(r.text, "html.parser")
-  data = {"somerville/east": False}
-  for el in soup.find_all("div", class_="searchResult"):
-    item_type = el.select("div.recordDetailValue > span.itemMediaDescription")[0].string.strip()
-    if item_type == "BOOK":
-#      items_container = el.select("div.ItemsContainer")
-      table = el.select("div.bibHoldingsWrapper table.itemTable")
-      for row in table[0]("tr"):
-        tds = list(row("td"))
-        if not tds:
-          continue
-        print(tds[0])
-        if tds[0].string.strip().startswith("SOMERVILLE/EAST"):
-          if tds[2].chilren[0].string.strip() == "Available":
-            data["somerville/east"] = "Available"
-            break
-
-#      availability_message = items_container[0].select_one("span.availabilityMessage")
-#      print(availability_message.string.strip())
-#      if (availability_message.select("span.itemsAvailable")[0].string.strip() == "Available"
-#         and availability_message.string.strip()
-#      availability = el.select("div.ItemsContainer span.itemsAvailable")[0].string.strip()
-#      data["somerville/east"] = availability
-  return data
+  return minuteman_holdings(title, author, ("SOMERVILLE/EAST",))
 
 
 # The Internet Archive's Open Library is easy, with a documented JSON API.
 
 
+@stats.timed("open_library")
+@cache.cached("open_library", positive_ttl=2 * cache.DAY, negative_ttl=7 * cache.DAY,
+              found=bool)
 def open_library(title, author):
   """Read from Open Library.
 
   Documentation is at https://openlibrary.org/dev/docs/api/search ."""
-  r = requests.get("https://openlibrary.org/search.json",
-                   params={"q": title,
-                           "author": author,
-                           "mode": "ebooks",
-                           "has_fulltext": "true"})
+  url = OPEN_LIBRARY_URL + "/search.json"
+  r = transport.get(url,
+                    params={"q": title,
+                            "author": author,
+                            "mode": "ebooks",
+                            "has_fulltext": "true"})
   r.raise_for_status()
   for doc in r.json()["docs"]:
 #    if doc["title"].lower() == title.lower() and [True for a in doc.get("author_name", []) if a.lower() == author]:
@@ -359,65 +504,252 @@ def open_library(title, author):
   return False
 
 
-def find_book(full_title, author, overdrive_subdomains=OVERDRIVE_SUBDOMAINS):
+# Each source checks whether a book is available there, and returns what to add to its
+# record if it is, or None. scheduler.py learns which ones to ask first.
+
+source_order = scheduler.Scheduler()
+
+
+def check_gutenberg(title_parts, author):
+  gut = gutenberg(title_parts["title"], author)
+  return {"gutenberg": gut} if gut else None
+
+
+def check_hoopla(title_parts, author):
+  hoopla = minuteman(mln_title(title_parts), author)["hoopla"]
+  return {"hoopla": hoopla} if hoopla else None
+
+
+def check_overdrive(subdomain, title_parts, author):
+  lookup = overdrive(subdomain, overdrive_title(title_parts), author)
+  if lookup["available"]:
+    return {"overdrive": subdomain, "overdrive_url": lookup["url"]}
+  return None
+
+
+def check_open_library(title_parts, author):
+  if not olindex.might_have(title_parts["title"]):
+    stats.cache_outcome("open_library", "not_in_index")
+    return None
+  return {"openlibrary": True} if open_library(title_parts["title"], author) else None
+
+
+def book_sources(overdrive_subdomains):
+  """Return {name: check} for every source, in the fixed order."""
+  sources = {"gutenberg": check_gutenberg, "hoopla": check_hoopla}
+  for subdomain in overdrive_subdomains:
+    sources["overdrive " + subdomain] = functools.partial(check_overdrive, subdomain)
+  sources["openlibrary"] = check_open_library
+  return sources
+
+
+@stats.timed("find_book")
+def find_book(full_title, author, overdrive_subdomains=OVERDRIVE_SUBDOMAINS, cancelled=None):
   """For each book, look it up in Minuteman for Hoopla, and in various Overdrive feeds.
 
-  Also looks at Open Library and Gutenberg.
+  Also looks at Open Library and Gutenberg. Sources are asked one at a time, in the
+  order the scheduler picks, until one has the book, or until the cancelled event is
+  set, in which case the result is incomplete.
+
+  If no source has the book but some couldn't be asked, their names are listed under
+  "failed", since the book may be available after all. lookup_failed checks for that.
 
   Consolidate the data to tell us where to look for it."""
   title_parts = extract_title(full_title)
   data = {"title": full_title,
           "author": author}
-  gut = gutenberg(title_parts["title"], author)
-  if gut:
-    data["gutenberg"] = gut
-    return data
-  try:
-    mln_lookup = minuteman(mln_title(title_parts), author)
-    if mln_lookup["hoopla"]:
-      data["hoopla"] = mln_lookup["hoopla"]
+  sources = book_sources(overdrive_subdomains)
+  failed = []
+  for name in source_order.order(sources):
+    if cancelled is not None and cancelled.is_set():
       return data
-  except requests.exceptions.HTTPError as e:
-    sys.stderr.write(str(e))
-  overdrive_place = None
-  for subdomain in overdrive_subdomains:
+    start = time.perf_counter()
     try:
-      overdrive_lookup = overdrive(subdomain, overdrive_title(title_parts), author)
-      if overdrive_lookup["available"]:
-        overdrive_place = subdomain
-        data["overdrive"] = overdrive_place
-        data["overdrive_url"] = overdrive_lookup["url"]
-        return data
-    except requests.exceptions.HTTPError as e:
+      found = sources[name](title_parts, author)
+    except requests.exceptions.RequestException as e:
       sys.stderr.write(str(e))
-  try:
-    data["openlibrary"] = open_library(title_parts["title"], author)
-  except requests.exceptions.HTTPError as e:
-    sys.stderr.write(str(e))
+      # An outage says nothing about whether the source has books.
+      failed.append(name)
+      continue
+    source_order.record(name, found, time.perf_counter() - start)
+    if found:
+      data.update(found)
+      stats.source(name)
+      return data
+  stats.source("none")
+  if failed:
+    data["failed"] = failed
   return data
 
 
-def find_physical_book(full_title, author):
-  """For each book, look it up in the Somerville East branch."""
+def lookup_failed(book):
+  """Whether find_book couldn't ask every source, so the book's status is unknown."""
+  return bool(book.get("failed"))
+
+
+class Journal:
+  """A record of each finished lookup, so a run that dies can pick up where it left off.
+
+  Each line is one find_book result. When resuming, the books already in the journal
+  aren't looked up again."""
+
+  def __init__(self, path, resume=False):
+    self.path = path
+    self.done = {}
+    self.lock = threading.Lock()
+    if resume and os.path.exists(path):
+      with open(path, "r+b") as f:
+        end = 0
+        for line in f:
+          # The last line may have been cut off when the run died.
+          if not line.endswith(b"\n"):
+            break
+          end += len(line)
+          try:
+            book = json.loads(line)
+          except ValueError as e:
+            sys.stderr.write("Skipping a journal line: {}\n".format(e))
+            continue
+          self.done[book_key(book["title"], book["author"])] = book
+        # So the next line doesn't run on from a cut off one.
+        f.truncate(end)
+    self.f = open(path, "a" if resume else "w")
+
+  def record(self, book):
+    """Add a finished lookup. One that a provider failed isn't finished, so a resumed
+    run tries it again."""
+    if lookup_failed(book):
+      return
+    with self.lock:
+      self.f.write(json.dumps(book) + "\n")
+      self.f.flush()
+
+  def finish(self):
+    """Close the journal, and remove it, since the run's output is complete."""
+    self.f.close()
+    os.remove(self.path)
+
+
+def lookup_key(title, author):
+  """Reduce a book to what matters for looking it up, so that small differences in how
+  it's written, like a series name, a leading article or "Last, First", share a key."""
+  title = cache.normalize(extract_title(title)["title"]).split()
+  if title and title[0] in ("the", "a", "an"):
+    title = title[1:]
+  return " ".join(title), " ".join(sorted(cache.normalize(author).split()))
+
+
+# Set to send lookups to daemon.py when it is running. It's off unless asked for, since
+# the daemon looks books up with this module too.
+use_daemon = False
+
+
+def find_books(books, overdrive_subdomains=OVERDRIVE_SUBDOMAINS, workers=WORKERS, journal=None):
+  """Look up (title, author) pairs in parallel, yielding the results in the same order.
+
+  Pairs that lookup_key says are the same book are only looked up once, and the result
+  is given to each of them. Each book is still checked one source at a time by
+  find_book, stopping at the first one that has it. throttle.py keeps the parallel
+  requests to each host polite.
+
+  If there is a journal, books already in it are skipped, and new results are added.
+
+  If the caller stops early and closes the generator, books that haven't been started
+  are dropped, and the ones being looked up stop after their current request.
+
+  With use_daemon set, the lookups are sent to daemon.py if it is running."""
+  if use_daemon:
+    try:
+      yield from daemon_find_books(books, overdrive_subdomains, workers, journal)
+      return
+    except daemon.NotRunning:
+      pass
+
+  find = stats.profiled(find_book)
+  cancelled = threading.Event()
+
+  def lookup(book):
+    if journal and book_key(book[0], book[1]) in journal.done:
+      return journal.done[book_key(book[0], book[1])]
+    sys.stderr.write("{} by {}\n".format(book[0], book[1]))
+    result = find(book[0], book[1], overdrive_subdomains, cancelled)
+    if journal and not cancelled.is_set():
+      journal.record(result)
+    return result
+
+  books = list(books)
+  unique = {}
+  for title, author in books:
+    unique.setdefault(lookup_key(title, author), (title, author))
+  executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+  try:
+    lookups = zip(unique, executor.map(lookup, unique.values()))
+    results = {}
+    for title, author in books:
+      key = lookup_key(title, author)
+      # Books are first seen in list order, so the result needed is already in hand or
+      # is the next one.
+      if key not in results:
+        done_key, result = next(lookups)
+        results[done_key] = result
+      if (title, author) == unique[key]:
+        yield results[key]
+      else:
+        yield dict(results[key], title=title, author=author)
+  finally:
+    cancelled.set()
+    executor.shutdown(cancel_futures=True)
+    source_order.save()
+
+
+def daemon_find_books(books, overdrive_subdomains, workers, journal):
+  """find_books, with the lookups done by daemon.py and the journal kept here."""
+  books = list(books)
+  done = journal.done if journal else {}
+  lookups = daemon.find_books([book for book in books if book_key(*book) not in done],
+                              list(overdrive_subdomains), workers)
+  with contextlib.closing(lookups):
+    for title, author in books:
+      if book_key(title, author) in done:
+        yield done[book_key(title, author)]
+        continue
+      result = next(lookups)
+      sys.stderr.write("{} by {}\n".format(title, author))
+      if journal:
+        journal.record(result)
+      yield result
+
+
+def iter_available(books, overdrive_subdomains=OVERDRIVE_SUBDOMAINS, workers=WORKERS,
+                   journal=None, limit=None):
+  """Yield the available books among (title, author) pairs, as they are found.
+
+  With a limit, stop looking once that many have been found."""
+  count = 0
+  with contextlib.closing(find_books(books, overdrive_subdomains, workers, journal)) as lookups:
+    for book in lookups:
+      if found_book(book):
+        yield book
+        count += 1
+        if limit and count >= limit:
+          return
+
+
+def find_physical_book(full_title, author, branches=MINUTEMAN_BRANCHES):
+  """For each book, look it up in the Minuteman branches, such as Somerville East."""
   title_parts = extract_title(full_title)
   data = {"title": full_title,
           "author": author}
   try:
-    lookup = somervilleeast(mln_title(title_parts), author)
-    if lookup["somerville/east"]:
-      data["somerville/east"] = lookup["somerville/east"]
-      return data
-  except requests.exceptions.HTTPError as e:
+    lookup = minuteman_holdings(mln_title(title_parts), author, branches)
+    for branch, status in lookup.items():
+      if status:
+        data[branch] = status
+  except requests.exceptions.RequestException as e:
     sys.stderr.write(str(e))
   return data
 
 
-def wrong_shelf(row):
-  if "Bookshelves" in row:
-    shelves = map(str.strip, row["Bookshelves"].split(","))
-    return "to-read" not in shelves
-
-
 def found_book(book):
   return (book.get("hoopla")
           or book.get("overdrive")
@@ -425,18 +757,162 @@ def found_book(book):
           or book.get("gutenberg"))
 
 
-def library(goodreads_csv, overdrive_subdomains):
-  """Print JSON for which books from the filename are immediately available to take out at a library."""
+def read_books(goodreads_csv, positions=None):
+  """Return (title, author) pairs for the rows of the CSV that are to be read.
+
+  If positions is a dict, it gets each book's place on the to-read shelf, by book_key."""
   reader = csv.DictReader(goodreads_csv)
-  items = []
+  books = []
   for row in reader:
-    if wrong_shelf(row):
+    if shelves.wrong_shelf(row):
       continue
-    sys.stderr.write("{} by {}\n".format(row["Title"], row["Author"]))
-    book = find_book(row["Title"], row["Author"], overdrive_subdomains)
-    if found_book(book):
-      items.append(book)
-  return items
+    books.append((row["Title"], row["Author"]))
+    if positions is not None and shelves.to_read_position(row) is not None:
+      positions[book_key(row["Title"], row["Author"])] = shelves.to_read_position(row)
+  return books
+
+
+def history_date(path):
+  """The date in a history file's name, which is when it was written."""
+  match = re.search(r"\d{4}-\d{2}-\d{2}T[0-9:+-]+", os.path.basename(path))
+  return match.group(0) if match else ""
+
+
+def recently_available(history):
+  """Return the book_keys of the books that were available at the last run.
+
+  history is either a JSON list of books, like available_books.json, or a directory
+  of them and of the .delta.json files from --delta, which are replayed in order."""
+  if not history or not os.path.exists(history):
+    return set()
+  if not os.path.isdir(history):
+    paths = [history]
+  else:
+    paths = sorted((os.path.join(history, name) for name in os.listdir(history)
+                    if name.endswith(".json")), key=history_date)
+  available = set()
+  for path in paths:
+    try:
+      with open(path) as f:
+        books = json.load(f)
+    except (OSError, ValueError) as e:
+      sys.stderr.write("Skipping history file {}: {}\n".format(path, e))
+      continue
+    if isinstance(books, list):
+      available = set(book_key(book["title"], book["author"]) for book in books)
+    else:
+      available |= set(book_key(book["title"], book["author"]) for book in books["added"])
+      available -= set(book_key(book["title"], book["author"]) for book in books["removed"])
+  return available
+
+
+def prioritize(books, recent=(), positions=None):
+  """Sort (title, author) pairs so that the books likeliest to be wanted come first.
+
+  Those are the recently available ones, then the others by their place on the to-read
+  shelf. Otherwise the list order is kept."""
+  positions = positions or {}
+  def priority(i):
+    key = book_key(*books[i])
+    return (key not in recent, positions.get(key, float("inf")), i)
+  return [books[i] for i in sorted(range(len(books)), key=priority)]
+
+
+def iter_library(goodreads_csv, overdrive_subdomains, workers=WORKERS, journal=None,
+                 limit=None, history=None):
+  """Yield each book from the CSV that is available, as soon as it has been looked up.
+
+  With a limit, the books are looked up in priority order, and only until that many
+  are available. history is for recently_available."""
+  positions = {}
+  books = read_books(goodreads_csv, positions)
+  if limit:
+    books = prioritize(books, recently_available(history), positions)
+  yield from iter_available(books, overdrive_subdomains, workers, journal, limit)
+
+
+def library(goodreads_csv, overdrive_subdomains, workers=WORKERS, journal=None, limit=None,
+            history=None):
+  """Print JSON for which books from the filename are immediately available to take out at a library."""
+  return list(iter_library(goodreads_csv, overdrive_subdomains, workers, journal, limit,
+                           history))
+
+
+def incremental_library(goodreads_csv, overdrive_subdomains, state_dir, workers=WORKERS,
+                        recheck_after=RECHECK_AFTER, journal=None):
+  """Like library(), but only look up the books whose status may have changed.
+
+  state_dir keeps the last run's input and output, and when each book was last checked.
+  Books found on Gutenberg stay there, so they are never checked again. Books that are
+  new to the list are checked first, then available books, since they are the ones
+  being shown, and then unavailable books that haven't been checked for recheck_after
+  seconds. Everything else keeps its result from before, as does a book that couldn't
+  be looked up because a provider failed, which is checked again on the next run.
+
+  Returns the available books, in list order, and the change since the last run as
+  {"added": [books], "removed": [books]}."""
+  books = read_books(goodreads_csv)
+  previous_books = set()
+  previous_found = {}
+  checked = {}
+  previous_csv = os.path.join(state_dir, "to_read.csv")
+  previous_json = os.path.join(state_dir, "available_books.json")
+  checked_json = os.path.join(state_dir, "checked.json")
+  if os.path.exists(previous_csv):
+    with open(previous_csv, newline="") as f:
+      previous_books = set(book_key(*book) for book in read_books(f))
+  if os.path.exists(previous_json):
+    with open(previous_json) as f:
+      previous_found = {book_key(book["title"], book["author"]): book for book in json.load(f)}
+  if os.path.exists(checked_json):
+    with open(checked_json) as f:
+      checked = json.load(f)
+
+  now = time.time()
+  results = {}
+  new = []
+  available = []
+  due = []
+  for i, (title, author) in enumerate(books):
+    key = book_key(title, author)
+    old = previous_found.get(key)
+    if key not in previous_books:
+      new.append(i)
+    elif old and old.get("gutenberg"):
+      results[i] = old
+    elif old:
+      available.append(i)
+    elif now - checked.get(key, 0) >= recheck_after:
+      due.append(i)
+  order = new + available + due
+  sys.stderr.write("{} new, {} available and {} unavailable books to check, of {}\n".format(
+    len(new), len(available), len(due), len(books)))
+  lookups = find_books([books[i] for i in order], overdrive_subdomains, workers, journal)
+  for i, book in zip(order, lookups):
+    key = book_key(*books[i])
+    if lookup_failed(book):
+      # Keep what was known before, and try again next run.
+      results[i] = previous_found.get(key, book)
+      continue
+    results[i] = book
+    checked[key] = now
+
+  items = [results[i] for i in range(len(books)) if i in results and found_book(results[i])]
+  found = {book_key(book["title"], book["author"]): book for book in items}
+  delta = {"added": [book for key, book in found.items() if key not in previous_found],
+           "removed": [book for key, book in previous_found.items() if key not in found]}
+
+  os.makedirs(state_dir, exist_ok=True)
+  def write_csv(f):
+    writer = csv.writer(f)
+    writer.writerow(["Title", "Author"])
+    writer.writerows(books)
+  util.write_atomically(previous_csv, write_csv)
+  util.write_atomically(previous_json, lambda f: json.dump(items, f))
+  current = set(book_key(*book) for book in books)
+  util.write_atomically(checked_json, lambda f: json.dump(
+    {key: when for key, when in checked.items() if key in current}, f))
+  return items, delta
 
 
 def physical_library(goodreads_csv):
@@ -444,33 +920,156 @@ def physical_library(goodreads_csv):
   reader = csv.DictReader(goodreads_csv)
   items = []
   for row in reader:
-    if wrong_shelf(row):
+    if shelves.wrong_shelf(row):
       continue
     sys.stderr.write("{} by {}\n".format(row["Title"], row["Author"]))
     book = find_physical_book(row["Title"], row["Author"])
-    if "somerville/east" in book:
+    if any(branch.lower() in book for branch in MINUTEMAN_BRANCHES):
       items.append(book)
   return items
 
 
-def usage(prog):
-  print("Usage: {} goodreads.csv")
+def parse_args(argv):
+  parser = argparse.ArgumentParser(prog=argv[0], description=__doc__.split("\n\n")[0])
+  parser.add_argument("goodreads_csv", nargs="?",
+                      help="CSV of books to look up (default: standard input)")
+  parser.add_argument("overdrive_subdomains", nargs="?",
+                      help="comma-separated Overdrive subdomains (default: {})".format(
+                        ",".join(OVERDRIVE_SUBDOMAINS)))
+  parser.add_argument("--ndjson", action="store_true",
+                      help="write each available book on its own line as soon as it is found, "
+                      "instead of one JSON list at the end")
+  parser.add_argument("--incremental", metavar="STATE_DIR",
+                      help="only look up books that are new or may have changed since the "
+                      "last run that used STATE_DIR")
+  parser.add_argument("--recheck-days", type=float, default=RECHECK_AFTER / (24 * 60 * 60),
+                      help="with --incremental, days before an unavailable book is checked "
+                      "again (default: %(default)s)")
+  parser.add_argument("--delta", metavar="PATH",
+                      help="with --incremental, also write the books added and removed since "
+                      "the last run to PATH")
+  parser.add_argument("--output", metavar="PATH",
+                      help="write the results to PATH, replacing it only when the run "
+                      "finishes (default: standard output)")
+  parser.add_argument("--journal", metavar="PATH",
+                      help="record each lookup in PATH as it finishes (default: the output "
+                      "path plus .journal, when there is one)")
+  parser.add_argument("--resume", action="store_true",
+                      help="skip the books already in the journal from a run that didn't "
+                      "finish")
+  parser.add_argument("--limit", type=int, metavar="N",
+                      help="stop once N available books have been found, looking up the "
+                      "books likeliest to be wanted first")
+  parser.add_argument("--history", metavar="PATH",
+                      help="with --limit, look up first the books that were available in "
+                      "PATH, a previous output or a directory of them and --delta files")
+  parser.add_argument("--workers", type=int, default=WORKERS,
+                      help="how many books to look up at once (default: %(default)s)")
+  parser.add_argument("--rate", action="append", default=[], metavar="DOMAIN=RATE",
+                      type=util.parse_rate,
+                      help="limit requests per second to DOMAIN and its subdomains, "
+                      "for example find.minlib.net=0.5 (can be repeated)")
+  parser.add_argument("--order", choices=("adaptive", "fixed"), default="adaptive",
+                      help="ask first the sources that have had the most books for the "
+                      "least time, or always Gutenberg, Hoopla, Overdrive in the given "
+                      "order and then Open Library (default: %(default)s)")
+  parser.add_argument("--no-cache", action="store_true",
+                      help="ask every provider again instead of using cached results "
+                      "(the new results are still cached)")
+  parser.add_argument("--stats", action="store_true",
+                      help="write request counts, latencies, cache hits and where each book "
+                      "was found as JSON, next to --output as NAME.stats.json, or else to "
+                      "standard error")
+  parser.add_argument("--profile", metavar="PATH",
+                      help="profile the lookups and save the result to PATH, for pstats")
+  parser.add_argument("--in-process", action="store_true",
+                      help="look the books up in this process even if daemon.py is running "
+                      "(always done with --no-cache, --rate, --order fixed, --stats or "
+                      "--profile, which only change this process)")
+  parser.add_argument("--refresh-gutenberg", nargs="?", const=GUTINDEX_URL, metavar="SOURCE",
+                      help="update the saved Gutenberg catalog from SOURCE, a URL or a local "
+                      "copy of GUTINDEX.ALL (default: {}), and exit".format(GUTINDEX_URL))
+  parser.add_argument("--full", action="store_true",
+                      help="with --refresh-gutenberg, rebuild the catalog from scratch")
+  args = parser.parse_args(argv[1:])
+  if not args.journal and args.output:
+    args.journal = args.output + ".journal"
+  if args.resume and not args.journal:
+    parser.error("--resume needs --journal or --output")
+  if args.limit and args.incremental:
+    parser.error("--limit can't be used with --incremental")
+  return args
 
 
 def main(argv):
+  global use_daemon
+  args = parse_args(argv)
+  if args.refresh_gutenberg:
+    added = refresh_gutenberg(args.refresh_gutenberg, args.full)
+    sys.stderr.write("{} Gutenberg records added\n".format(added))
+    return
+
+  cache.bypass = args.no_cache
+  source_order.adaptive = args.order == "adaptive"
+  use_daemon = not (args.in_process or args.no_cache or args.rate or args.order == "fixed"
+                    or args.stats or args.profile)
+  for domain, per_second in args.rate:
+    throttle.set_rate(domain, per_second)
   overdrive_subdomains = OVERDRIVE_SUBDOMAINS
-  def inner(f):
-    json.dump(library(f, overdrive_subdomains), sys.stdout)
+  if args.overdrive_subdomains:
+    overdrive_subdomains = args.overdrive_subdomains.split(",")
+  journal = None
+  if args.journal:
+    journal = Journal(args.journal, args.resume)
+
+  def inner(f, out):
+    if args.incremental:
+      items, delta = incremental_library(f, overdrive_subdomains, args.incremental,
+                                         args.workers, args.recheck_days * 24 * 60 * 60,
+                                         journal)
+      if args.delta:
+        delta["date"] = time.strftime("%Y-%m-%dT%H:%M%z")
+        util.write_atomically(args.delta, lambda d: json.dump(delta, d))
+      if args.ndjson:
+        for book in items:
+          print(json.dumps(book), file=out)
+      else:
+        json.dump(items, out)
+        print(file=out)
+    elif args.ndjson:
+      for book in iter_library(f, overdrive_subdomains, args.workers, journal, args.limit,
+                               args.history):
+        print(json.dumps(book), file=out, flush=True)
+    else:
+      json.dump(library(f, overdrive_subdomains, args.workers, journal, args.limit,
+                        args.history), out)
+      print(file=out)
 
-  if len(argv) < 2:
-    inner(sys.stdin)
-  else:
-    if len(argv) > 2:
-      overdrive_subdomains = argv[2].split(",")
-    with open(argv[1]) as f:
-      inner(f)
+  def run(out):
+    if not args.goodreads_csv:
+      inner(sys.stdin, out)
+    else:
+      with open(args.goodreads_csv) as f:
+        inner(f, out)
 
-  print()
+  if args.profile:
+    stats.start_profiling()
+  if args.output:
+    util.write_atomically(args.output, run)
+  else:
+    run(sys.stdout)
+  if journal:
+    journal.finish()
+  if args.profile:
+    stats.dump_profile(args.profile)
+  if args.stats:
+    def write_stats(f):
+      json.dump(stats.report(), f, indent=2)
+      f.write("\n")
+    if args.output:
+      util.write_atomically(os.path.splitext(args.output)[0] + ".stats.json", write_stats)
+    else:
+      write_stats(sys.stderr)
 
 
 if __name__ == "__main__":
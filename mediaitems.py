@@ -0,0 +1,128 @@
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Read the mediaItems JSON out of an Overdrive search page as it downloads.
+
+The books are in one JSON object assigned to window.OverDrive.mediaItems, partway
+through a large page. The page is read in chunks until that line, and only the last
+few bytes are kept while looking for it. From there the raw bytes are searched in place
+for a brace that ends the statement and closes the object, counting braces as they
+arrive, and only then is the object decoded and parsed, once. The rest of the page is
+never read. A page that ends first raises PageError, which is a RequestException like
+any other failed request.
+"""
+
+import json
+import re
+import requests
+
+
+CHUNK_SIZE = 16 * 1024
+MARKER = b"window.OverDrive.mediaItems = "
+# Where the object could end: a closing brace at the end of the statement or line.
+OBJECT_END = re.compile(rb"\}[ \t]*(?:;|\r?$|</script>)", re.MULTILINE)
+LEADING_SPACE = re.compile(rb"\s*")
+# Bytes left unsearched at the end of the buffer, in case a brace there is followed by
+# the end of the statement in the next chunk.
+TAIL = 16
+
+
+class PageError(requests.exceptions.RequestException):
+  """The page ended, or stopped being JSON, before the end of mediaItems."""
+
+
+def decode(buf, start, end):
+  """Parse the object at start, decoding the bytes up to end without copying them
+  first. Raises json.JSONDecodeError if it doesn't end by then."""
+  with memoryview(buf)[:end] as view:
+    try:
+      text = str(view, "utf-8")
+    except UnicodeDecodeError as e:
+      raise PageError("Overdrive's mediaItems isn't UTF-8: {}".format(e))
+  return json.JSONDecoder().raw_decode(text, start)[0]
+
+
+def parse_object(buf, state):
+  """Parse the object at the start of buf, if it has all arrived.
+
+  state is {"pos", "depth"}: how far the braces have been counted, and how many were
+  open there. The bytes are only decoded and parsed at a brace that ends a statement
+  and closes as many as were opened, so each byte is normally parsed once. Returns
+  the object, or None if more bytes are needed."""
+  start = LEADING_SPACE.match(buf).end()
+  while True:
+    m = OBJECT_END.search(buf, state["pos"])
+    end = m.end() if m else max(state["pos"], len(buf) - TAIL)
+    state["depth"] += buf.count(b"{", state["pos"], end) - buf.count(b"}", state["pos"], end)
+    state["pos"] = end
+    if m is None:
+      return None
+    if state["depth"] > 0:
+      continue
+    try:
+      return decode(buf, start, m.start() + 1)
+    except json.JSONDecodeError:
+      # A brace in a string threw the count off. The object can't end before here,
+      # or it would have parsed, so go on counting.
+      continue
+
+
+def slim(media_items):
+  """Keep only what overdrive() looks at, with the type reduced to its name."""
+  return {key: {"title": item.get("title"),
+                "type": (item.get("type") or {}).get("name"),
+                "isAvailable": bool(item.get("isAvailable"))}
+          for key, item in media_items.items()}
+
+
+def media_items(chunks):
+  """Read {id: {"title", "type", "isAvailable"}} from an iterable of page chunks.
+
+  Stops consuming chunks once the object ends. Returns None if the page doesn't have
+  the mediaItems line."""
+  buf = bytearray()
+  chunks = iter(chunks)
+  for chunk in chunks:
+    buf += chunk
+    start = buf.find(MARKER)
+    if start != -1:
+      del buf[:start + len(MARKER)]
+      break
+    # Keep just enough to find the marker if it's split between chunks.
+    del buf[:max(0, len(buf) - len(MARKER) + 1)]
+  else:
+    return None
+
+  while not buf.strip():
+    chunk = next(chunks, None)
+    if chunk is None:
+      return None
+    buf += chunk
+  if buf[LEADING_SPACE.match(buf).end()] != ord("{"):
+    return {}
+  state = {"pos": 0, "depth": 0}
+  while True:
+    items = parse_object(buf, state)
+    if items is not None:
+      return slim(items)
+    chunk = next(chunks, None)
+    if chunk is None:
+      break
+    buf += chunk
+  # Braces in strings could have kept the count from reaching the end.
+  try:
+    return slim(decode(buf, LEADING_SPACE.match(buf).end(), len(buf)))
+  except json.JSONDecodeError:
+    raise PageError("Overdrive page ended inside mediaItems")
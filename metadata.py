@@ -14,27 +14,219 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""This is an experiment into looking up metadata (mainly page length).
-
-It uses the Google Books API.
+"""Add page counts and ISBNs to a list of available books, from Google Books.
 
 The main trouble is that there are many editions of books and it's hard to
-know which edition a library is lending.
+know which edition a library is lending. A Goodreads export at least has the ISBNs
+of the edition that was shelved, so a book is looked up by those when the CSV has
+them, and otherwise by title and author, taking the first volume with that title and
+a page count.
+
+Books that would make the same query share it, and answers are kept by cache.py, by
+ISBN or by normalized title and author, so a repeat run over the same list makes few
+requests, if any. Queries run a few at a time, rate limited by throttle.py, and a run
+makes at most QUOTA of them, to stay inside Google's daily quota. Books past that are
+left for the next run, and once the quota is spent, stale answers are used as they
+are instead of being refreshed in the background.
+
+search() prints what a query finds, for trying queries out.
+
+The API is at GOOGLE_BOOKS_URL, which can be pointed at benchmarks/replay_server.py.
+If GOOGLE_BOOKS_API_KEY is set, it is sent with each query.
+
+Usage: metadata.py [--csv GOODREADS_CSV] [--output PATH] [--quota N] AVAILABLE_BOOKS_JSON
 """
 
+import argparse
+import cache
+import concurrent.futures
+import csv
+import json
+import os
+import re
 import requests
+import shelves
+import stats
+import sys
+import threading
+import throttle
+import transport
+import util
+
+
+GOOGLE_BOOKS_URL = os.environ.get("LIBRARY_GOOGLE_BOOKS_URL", "https://www.googleapis.com")
+API_KEY = os.environ.get("GOOGLE_BOOKS_API_KEY")
+
+# Queries per run. Google allows 1000 a day without asking for more.
+QUOTA = 200
+WORKERS = 4
+
+
+class QuotaSpent(Exception):
+  pass
+
+
+class Quota:
+  """Count queries, and refuse any past the limit."""
+
+  def __init__(self, limit):
+    self.left = limit
+    self.lock = threading.Lock()
+
+  def take(self):
+    with self.lock:
+      if self.left <= 0:
+        raise QuotaSpent()
+      self.left -= 1
+
+  def spent(self):
+    return self.left <= 0
+
+
+quota = Quota(QUOTA)
+
+
+def goodreads_isbn(value):
+  """Goodreads writes ISBNs as ="0441478123", so spreadsheets keep the leading zero."""
+  isbn = re.sub(r"[^0-9Xx]", "", value or "").upper()
+  return isbn or None
+
+
+def read_isbns(goodreads_csv):
+  """Return {book_key: ISBN} for the books in a Goodreads export, preferring ISBN13."""
+  isbns = {}
+  for row in csv.DictReader(goodreads_csv):
+    isbn = goodreads_isbn(row.get("ISBN13")) or goodreads_isbn(row.get("ISBN"))
+    if isbn:
+      isbns[shelves.book_key(row["Title"], row["Author"])] = isbn
+  return isbns
+
+
+def volumes(query):
+  """Search Google Books, returning the volumes found.
+
+  Documentation is at https://developers.google.com/books/docs/v1/using ."""
+  quota.take()
+  params = {"q": query}
+  if API_KEY:
+    params["key"] = API_KEY
+  r = transport.get(GOOGLE_BOOKS_URL + "/books/v1/volumes", params=params)
+  r.raise_for_status()
+  return r.json().get("items", [])
+
+
+def search(query):
+  """Print the title and page count of each volume a query finds."""
+  for volume in volumes(query):
+    info = volume["volumeInfo"]
+    print(info.get("title"), info.get("pageCount"))
+
+
+def volume_metadata(volume):
+  info = volume["volumeInfo"]
+  data = {"pages": info["pageCount"],
+          "google_books": volume["id"]}
+  for identifier in info.get("industryIdentifiers", []):
+    if identifier.get("type") == "ISBN_10":
+      data["isbn"] = identifier["identifier"]
+    elif identifier.get("type") == "ISBN_13":
+      data["isbn13"] = identifier["identifier"]
+  return data
+
+
+@stats.timed("google_books")
+@cache.cached("google_books_isbn", positive_ttl=30 * cache.DAY, negative_ttl=7 * cache.DAY,
+              found=bool, refresh_when=lambda: not quota.spent())
+def isbn_volume(isbn):
+  for volume in volumes("isbn:" + isbn):
+    if volume["volumeInfo"].get("pageCount"):
+      return volume_metadata(volume)
+  return None
+
+
+@stats.timed("google_books")
+@cache.cached("google_books", positive_ttl=30 * cache.DAY, negative_ttl=7 * cache.DAY,
+              found=bool, refresh_when=lambda: not quota.spent())
+def title_volume(title, author):
+  # Editions often add a subtitle or "and Other Stories", but shouldn't drop words.
+  wanted = cache.normalize(title)
+  for volume in volumes('intitle:"{}" inauthor:"{}"'.format(title, author)):
+    info = volume["volumeInfo"]
+    if info.get("pageCount") and cache.normalize(info.get("title")).startswith(wanted):
+      return volume_metadata(volume)
+  return None
+
+
+def book_metadata(isbn, title, author):
+  """Look a book up by ISBN, or by title and author if that finds nothing."""
+  return (isbn and isbn_volume(isbn)) or title_volume(title, author)
+
+
+def query(book, isbns):
+  """The arguments to book_metadata for a book, the same for books that share a query."""
+  isbn = isbns.get(shelves.book_key(book["title"], book["author"]))
+  title = shelves.extract_title(book["title"])["title"]
+  return isbn, cache.normalize(title), cache.normalize(book["author"])
+
+
+def enrich(books, isbns=None, workers=WORKERS):
+  """Add pages, isbn, isbn13 and google_books to each of the books that Google Books
+  knows, and return how many books were left for lack of quota."""
+  queries = {}
+  for book in books:
+    queries.setdefault(query(book, isbns or {}), []).append(book)
+
+  def ask(args):
+    try:
+      return book_metadata(*args)
+    except QuotaSpent:
+      return QuotaSpent
+    except requests.exceptions.RequestException as e:
+      sys.stderr.write("{}\n".format(e))
+      return None
+
+  left = 0
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+    for args, data in zip(queries, executor.map(ask, queries)):
+      if data is QuotaSpent:
+        left += len(queries[args])
+      elif data:
+        for book in queries[args]:
+          book.update(data)
+  return left
+
 
-def search(q):
-  params = {"q":q}
-  r = requests.get(url="https://www.googleapis.com/books/v1/volumes", params=params)
-  rj = r.json()
-  print(rj["totalItems"])
-  for i in rj["items"]:
-    print(i["volumeInfo"]["title"], i["volumeInfo"]["pageCount"])
+def main(argv):
+  parser = argparse.ArgumentParser(prog=argv[0], description=__doc__.split("\n\n")[0])
+  parser.add_argument("available_books", help="library.py's JSON output")
+  parser.add_argument("--csv", type=argparse.FileType("r"), metavar="GOODREADS_CSV",
+                      help="the Goodreads export the books came from, for their ISBNs")
+  parser.add_argument("--output", metavar="PATH",
+                      help="where to write the books (default: back to AVAILABLE_BOOKS_JSON)")
+  parser.add_argument("--quota", type=int, default=QUOTA,
+                      help="most queries to make (default: %(default)s)")
+  parser.add_argument("--workers", type=int, default=WORKERS,
+                      help="queries to make at once (default: %(default)s)")
+  parser.add_argument("--rate", action="append", default=[], metavar="DOMAIN=RATE",
+                      type=util.parse_rate,
+                      help="limit requests per second to DOMAIN and its subdomains, "
+                      "as in library.py (can be repeated)")
+  args = parser.parse_args(argv[1:])
 
-def main():
-  search("Good Omens")
+  global quota
+  quota = Quota(args.quota)
+  for domain, per_second in args.rate:
+    throttle.set_rate(domain, per_second)
+  with open(args.available_books) as f:
+    books = json.load(f)
+  isbns = read_isbns(args.csv) if args.csv else {}
+  left = enrich(books, isbns, args.workers)
+  util.write_atomically(args.output or args.available_books, lambda f: json.dump(books, f))
+  sys.stderr.write("{} of {} books have page counts, {} queries made\n".format(
+    sum(1 for book in books if "pages" in book), len(books), args.quota - quota.left))
+  if left:
+    sys.stderr.write("{} books left for the next run, with the quota spent\n".format(left))
 
 
 if __name__ == "__main__":
-  main()
+  main(sys.argv)
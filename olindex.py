@@ -0,0 +1,228 @@
+#! /usr/bin/env python3
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local index of the Open Library editions that can be read online.
+
+Most books on a list aren't on Open Library as e-books at all, and finding that out
+took a search per book. Open Library publishes monthly dumps of every record, at
+https://openlibrary.org/developers/dumps , and an edition can only be read or borrowed
+if it has been scanned, which the dump shows as an "ocaid". This streams the gzipped
+editions dump, keeps only the scanned editions, and writes their titles and authors in
+catalog.py's format. Author names come from the authors dump, if it's given, or else
+the edition's "by" statement. Open Library's search matches the work's title, which
+is often not the edition's, so with the works dump each edition is indexed under its
+works' titles too.
+
+The kept editions are written to a temporary file next to the index rather than held
+in memory, with only the author and work numbers they refer to kept for the joins, and
+are then read back one at a time as the index is written.
+
+library.py then only searches Open Library for books with a title in the index, which
+confirms that a copy is available now. Titles are compared as lowercase words, without
+a leading article, and any edition or work title counts, as does the part before a
+colon. That's looser than library.py's own title check, so the index never rules out a
+book the search would have found, as of the dump. Without an index file every book is
+searched, as before.
+
+Usage: olindex.py [--output PATH] [--works WORKS_DUMP] EDITIONS_DUMP [AUTHORS_DUMP]
+"""
+
+import argparse
+import catalog
+import gzip
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+
+
+INDEX_PATH = os.environ.get("LIBRARY_OPEN_LIBRARY_INDEX", "/tmp/olindex.cat")
+
+EDITION_NUMBER = re.compile(r"^/books/OL(\d+)M$")
+# Authors and works are kept by number while joining, which takes less memory.
+AUTHOR_NUMBER = re.compile(r"^/authors/OL(\d+)A$")
+WORK_NUMBER = re.compile(r"^/works/OL(\d+)W$")
+ARTICLES = ("the", "a", "an")
+
+index = None
+index_mtime = None
+index_lock = threading.Lock()
+
+
+def normalize(title):
+  """Lowercase words, without a leading article."""
+  words = re.findall(r"\w+", (title or "").lower())
+  if len(words) > 1 and words[0] in ARTICLES:
+    words = words[1:]
+  return " ".join(words)
+
+
+def open_dump(path):
+  if path.endswith(".gz"):
+    return gzip.open(path, "rt", encoding="utf8")
+  return open(path, encoding="utf8")
+
+
+def records(lines, record_type, needle=None):
+  """Yield (key, record) for the dump lines of the given type.
+
+  Each line is type, key, revision, last modified and the JSON record, separated by
+  tabs. Lines without needle aren't parsed, which skips most of a large dump."""
+  prefix = record_type + "\t"
+  for line in lines:
+    if not line.startswith(prefix) or (needle and needle not in line):
+      continue
+    fields = line.rstrip("\n").split("\t", 4)
+    if len(fields) != 5:
+      continue
+    try:
+      yield fields[1], json.loads(fields[4])
+    except ValueError:
+      continue
+
+
+def numbers(refs, pattern):
+  """The numbers in the keys of a list of {"key": ...} references."""
+  found = []
+  for ref in refs or []:
+    match = pattern.match(ref.get("key", "")) if isinstance(ref, dict) else None
+    if match:
+      found.append(int(match.group(1)))
+  return found
+
+
+def readable_editions(lines):
+  """Yield (edition number, titles, author numbers, work numbers, by statement) for
+  scanned editions."""
+  for key, edition in records(lines, "/type/edition", '"ocaid"'):
+    match = EDITION_NUMBER.match(key)
+    if not match or not edition.get("ocaid") or not edition.get("title"):
+      continue
+    titles = [edition["title"]] + edition.get("work_titles", [])
+    yield (int(match.group(1)), titles, numbers(edition.get("authors"), AUTHOR_NUMBER),
+           numbers(edition.get("works"), WORK_NUMBER), edition.get("by_statement"))
+
+
+def joined(lines, record_type, pattern, field, wanted):
+  """Return {number: record[field]} for the records of a dump in wanted."""
+  values = {}
+  for key, record in records(lines, record_type, '"{}"'.format(field)):
+    match = pattern.match(key)
+    if match and int(match.group(1)) in wanted and record.get(field):
+      values[int(match.group(1))] = record[field]
+  return values
+
+
+def build(editions_dump, authors_dump=None, path=INDEX_PATH, works_dump=None):
+  """Index the readable editions in the dumps, returning how many were kept."""
+  count = 0
+  authors = set()
+  works = set()
+  with tempfile.TemporaryFile("w+", encoding="utf8",
+                              dir=os.path.dirname(os.path.abspath(path))) as kept:
+    with open_dump(editions_dump) as f:
+      for edition in readable_editions(f):
+        kept.write(json.dumps(edition) + "\n")
+        authors.update(edition[2])
+        works.update(edition[3])
+        count += 1
+    names = {}
+    if authors_dump:
+      with open_dump(authors_dump) as f:
+        names = joined(f, "/type/author", AUTHOR_NUMBER, "name", authors)
+    del authors
+    work_titles = {}
+    if works_dump:
+      with open_dump(works_dump) as f:
+        work_titles = joined(f, "/type/work", WORK_NUMBER, "title", works)
+    del works
+
+    def index_records():
+      kept.seek(0)
+      for line in kept:
+        number, titles, author_numbers, work_numbers, by_statement = json.loads(line)
+        titles += [work_titles[work] for work in work_numbers if work in work_titles]
+        author = (", ".join(names[key] for key in author_numbers if key in names)
+                  or by_statement)
+        # A work is often called just what comes before the colon in its editions' titles.
+        for title in set(normalize(part) for title in titles
+                         for part in (title, title.partition(":")[0])):
+          if title:
+            yield title, author.lower() if author else None, number
+    catalog.write(path, index_records())
+  return count
+
+
+class Index:
+
+  def __init__(self, path):
+    self.catalog = catalog.Catalog(path)
+
+  def has_title(self, title):
+    """Whether some readable edition has this title."""
+    title = normalize(title)
+    words = title.split()
+    if not words:
+      return True
+    # Every match is among the records with the rarest word.
+    postings = min((self.catalog.postings(word) for word in words),
+                   key=lambda postings: sum(len(posting) for posting in postings))
+    return any(self.catalog.record(i)[0] == title
+               for posting in postings for i in posting)
+
+
+def current(path=INDEX_PATH):
+  """The index, opened again if it has been rebuilt, or None if there isn't one."""
+  global index, index_mtime
+  try:
+    mtime = os.stat(path).st_mtime
+  except FileNotFoundError:
+    return None
+  with index_lock:
+    if mtime != index_mtime:
+      index_mtime = mtime
+      try:
+        index = Index(path)
+      except (OSError, catalog.CatalogError) as e:
+        sys.stderr.write("Not using the Open Library index: {}\n".format(e))
+        index = None
+    return index
+
+
+def might_have(title):
+  """False if the index says Open Library has no readable edition with this title."""
+  found = current()
+  return found is None or found.has_title(title)
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(prog=argv[0], description=__doc__.split("\n\n")[0])
+  parser.add_argument("editions_dump", help="an Open Library editions dump, gzipped or not")
+  parser.add_argument("authors_dump", nargs="?",
+                      help="the authors dump from the same month, for author names")
+  parser.add_argument("--works", metavar="WORKS_DUMP",
+                      help="the works dump from the same month, for work titles")
+  parser.add_argument("--output", default=INDEX_PATH,
+                      help="where to write the index (default: %(default)s)")
+  args = parser.parse_args(argv[1:])
+  count = build(args.editions_dump, args.authors_dump, args.output, args.works)
+  sys.stderr.write("{} readable editions indexed\n".format(count))
+
+
+if __name__ == "__main__":
+  main(sys.argv)
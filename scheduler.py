@@ -0,0 +1,102 @@
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Which order to ask the sources about a book in.
+
+find_book stops at the first source that has a book, so the cheapest order asks
+sources with a good chance of having it for little time first. Each source's hit rate
+and time per check are kept from run to run, and sources are sorted by the expected
+time spent per hit, time / hit rate. A source nothing is known about yet starts out
+assumed slow and unlikely, and ties keep the order they were given in.
+
+Older checks count for less, so the order follows changes in what's on the list and
+in how fast each site is. In fixed mode the given order is always used.
+"""
+
+import json
+import os
+import sys
+import threading
+import util
+
+
+STATS_PATH = os.environ.get("LIBRARY_SOURCE_STATS", "/tmp/library_sources.json")
+
+# What a new source is assumed to be like, worth this many checks.
+PRIOR_HIT_RATE = 0.1
+PRIOR_SECONDS = 1.0
+PRIOR_WEIGHT = 2
+# After this many checks of a source, the older ones count for half.
+WINDOW = 500
+
+
+class Scheduler:
+
+  def __init__(self, path=STATS_PATH, adaptive=True):
+    self.path = path
+    self.adaptive = adaptive
+    self.sources = None
+    self.lock = threading.Lock()
+
+  def load(self):
+    """Read the saved statistics. The caller holds the lock."""
+    self.sources = {}
+    try:
+      with open(self.path) as f:
+        self.sources = json.load(f)
+    except FileNotFoundError:
+      pass
+    except (OSError, ValueError) as e:
+      sys.stderr.write("Not using source statistics from {}: {}\n".format(self.path, e))
+
+  def expected_cost(self, name):
+    """Seconds spent checking this source per book it has. The caller holds the lock."""
+    source = self.sources.get(name, {"checks": 0, "hits": 0, "seconds": 0})
+    checks = source["checks"] + PRIOR_WEIGHT
+    hit_rate = (source["hits"] + PRIOR_HIT_RATE * PRIOR_WEIGHT) / checks
+    seconds = (source["seconds"] + PRIOR_SECONDS * PRIOR_WEIGHT) / checks
+    return seconds / hit_rate
+
+  def order(self, names):
+    """Return the names in the order to check them."""
+    if not self.adaptive:
+      return list(names)
+    with self.lock:
+      if self.sources is None:
+        self.load()
+      return sorted(names, key=self.expected_cost)
+
+  def record(self, name, hit, seconds):
+    with self.lock:
+      if self.sources is None:
+        self.load()
+      source = self.sources.setdefault(name, {"checks": 0, "hits": 0, "seconds": 0})
+      source["checks"] += 1
+      source["hits"] += int(bool(hit))
+      source["seconds"] += seconds
+      if source["checks"] > WINDOW:
+        for key in source:
+          source[key] /= 2
+
+  def save(self):
+    """Write the statistics for the next run, if any were used or changed."""
+    with self.lock:
+      if self.sources is None:
+        return
+      report = json.dumps(self.sources, indent=2, sort_keys=True)
+    try:
+      util.write_atomically(self.path, lambda f: f.write(report + "\n"))
+    except OSError as e:
+      sys.stderr.write("Not saving source statistics to {}: {}\n".format(self.path, e))
@@ -0,0 +1,56 @@
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""What a Goodreads export row says about a book: the shelves it is on, and the series
+in its title.
+
+These are kept apart from library.py so that find.cgi and metadata.py can read a list
+without importing everything needed to look the books up.
+"""
+
+import re
+
+
+TO_READ_POSITION = re.compile(r'(?:^|,)\s*to-read \(#(\d+)\)')
+GOODREADS_SERIES_REGEX = re.compile(r'(.+)\(([^\)]*), [#](\d+)\)')
+
+
+def book_key(title, author):
+  return "{}\x1f{}".format(title, author or "")
+
+
+def extract_title(title):
+  """Parse a title that is part of a series as displayed by Goodreads."""
+  regex = GOODREADS_SERIES_REGEX.match(title)
+  if regex:
+    return {"title": regex.group(1).strip(),
+            "series": regex.group(2),
+            "number": regex.group(3)}
+  return {"title": title,
+          "series": None,
+          "number": None}
+
+
+def wrong_shelf(row):
+  if "Bookshelves" in row:
+    shelves = map(str.strip, row["Bookshelves"].split(","))
+    return "to-read" not in shelves
+
+
+def to_read_position(row):
+  """Where a book is on the to-read shelf, from Goodreads' "to-read (#12)", or None."""
+  match = TO_READ_POSITION.search(row.get("Bookshelves with positions") or "")
+  return int(match.group(1)) if match else None
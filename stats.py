@@ -0,0 +1,188 @@
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Counts of where a run spent its time, for telling which provider made it slow.
+
+Every run collects these, since counting is cheap, and library.py's --stats writes
+them out as JSON:
+
+  providers  calls, errors and a latency histogram for each provider function,
+             including the calls answered from the cache
+  cache      how each cached provider's lookups were answered: hit, stale, miss or
+             bypass, or not_in_index when olindex.py ruled the book out first
+  hosts      requests, statuses, latency and bytes received for each host
+  sources    which source each book was found at, or "none"
+  phases     time spent on one-off work, like building the Gutenberg catalog
+
+Profiling is separate and opt in, since it slows everything down. Each thread that
+runs a profiled function gets its own profiler, and they're combined at the end.
+"""
+
+import collections
+import contextlib
+import cProfile
+import functools
+import pstats
+import threading
+import time
+
+
+# Upper bounds of the latency histogram buckets, in milliseconds.
+BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+lock = threading.Lock()
+timings = {}
+errors = collections.Counter()
+cache_outcomes = collections.defaultdict(collections.Counter)
+hosts = {}
+sources = collections.Counter()
+phases = collections.Counter()
+
+profiling = False
+profilers = []
+local = threading.local()
+
+
+class Histogram:
+  """Call count, total and maximum time, and counts per latency bucket."""
+
+  def __init__(self):
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+    self.buckets = [0] * (len(BUCKETS) + 1)
+
+  def add(self, seconds):
+    self.count += 1
+    self.total += seconds
+    self.max = max(self.max, seconds)
+    ms = seconds * 1000
+    for i, bound in enumerate(BUCKETS):
+      if ms <= bound:
+        self.buckets[i] += 1
+        break
+    else:
+      self.buckets[-1] += 1
+
+  def report(self):
+    labels = ["<={}ms".format(bound) for bound in BUCKETS] + [">{}ms".format(BUCKETS[-1])]
+    return {"count": self.count,
+            "total_seconds": round(self.total, 3),
+            "mean_ms": round(self.total / self.count * 1000, 1) if self.count else 0,
+            "max_ms": round(self.max * 1000, 1),
+            "histogram": {label: n for label, n in zip(labels, self.buckets) if n}}
+
+
+def timed(name):
+  """Count calls to a function, how long they take and which ones raise."""
+  def decorator(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      start = time.perf_counter()
+      try:
+        return fn(*args, **kwargs)
+      except Exception:
+        with lock:
+          errors[name] += 1
+        raise
+      finally:
+        elapsed = time.perf_counter() - start
+        with lock:
+          timings.setdefault(name, Histogram()).add(elapsed)
+    return wrapper
+  return decorator
+
+
+def cache_outcome(provider, outcome):
+  with lock:
+    cache_outcomes[provider][outcome] += 1
+
+
+def request(host, status, seconds, received=0):
+  """Count one HTTP request, with status None for a connection failure or timeout."""
+  with lock:
+    if host not in hosts:
+      hosts[host] = {"latency": Histogram(), "statuses": collections.Counter(), "bytes": 0}
+    hosts[host]["latency"].add(seconds)
+    hosts[host]["statuses"][str(status)] += 1
+    hosts[host]["bytes"] += received
+
+
+def received(host, count):
+  """Add bytes read later from a streamed response."""
+  with lock:
+    hosts[host]["bytes"] += count
+
+
+def source(name):
+  with lock:
+    sources[name] += 1
+
+
+@contextlib.contextmanager
+def phase(name):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    with lock:
+      phases[name] += time.perf_counter() - start
+
+
+def report():
+  with lock:
+    return {
+      "providers": {name: dict(histogram.report(), errors=errors[name])
+                    for name, histogram in sorted(timings.items())},
+      "cache": {provider: dict(outcomes) for provider, outcomes in sorted(cache_outcomes.items())},
+      "hosts": {host: {"requests": state["latency"].count,
+                       "bytes": state["bytes"],
+                       "statuses": dict(state["statuses"]),
+                       "latency": state["latency"].report()}
+                for host, state in sorted(hosts.items())},
+      "sources": dict(sources),
+      "phases": {name: round(seconds, 3) for name, seconds in phases.items()},
+    }
+
+
+def profiled(fn):
+  """Profile calls to fn in each thread, once profiling has been turned on."""
+  @functools.wraps(fn)
+  def wrapper(*args, **kwargs):
+    if not profiling:
+      return fn(*args, **kwargs)
+    profiler = getattr(local, "profiler", None)
+    if profiler is None:
+      profiler = local.profiler = cProfile.Profile()
+      with lock:
+        profilers.append(profiler)
+    return profiler.runcall(fn, *args, **kwargs)
+  return wrapper
+
+
+def start_profiling():
+  global profiling
+  profiling = True
+
+
+def dump_profile(path):
+  """Combine every thread's profile into one file that pstats can read."""
+  with lock:
+    if not profilers:
+      return
+    combined = pstats.Stats(profilers[0])
+    for profiler in profilers[1:]:
+      combined.add(profiler)
+  combined.dump_stats(path)
@@ -0,0 +1,68 @@
+#! /usr/bin/env python3
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Resuming library.py's journal after a run died partway through a line.
+
+Usage: python3 -m unittest discover tests
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import library
+
+
+def book(n):
+  return {"title": "Book {}".format(n), "author": "Author {}".format(n), "hoopla": True}
+
+
+class ResumeTest(unittest.TestCase):
+
+  def setUp(self):
+    tmp = tempfile.TemporaryDirectory()
+    self.addCleanup(tmp.cleanup)
+    self.path = os.path.join(tmp.name, "journal.ndjson")
+
+  def resume(self):
+    journal = library.Journal(self.path, resume=True)
+    self.addCleanup(journal.f.close)
+    return journal
+
+  def test_resume_twice_after_truncated_write(self):
+    journal = library.Journal(self.path)
+    journal.record(book(1))
+    journal.record(book(2))
+    journal.f.close()
+    with open(self.path, "a") as f:
+      f.write('{"title": "Book 3", "au')
+
+    journal = self.resume()
+    self.assertEqual(len(journal.done), 2)
+    journal.record(book(4))
+    journal.f.close()
+
+    journal = self.resume()
+    self.assertEqual(sorted(done["title"] for done in journal.done.values()),
+                     ["Book 1", "Book 2", "Book 4"])
+
+
+if __name__ == "__main__":
+  unittest.main()
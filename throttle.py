@@ -0,0 +1,84 @@
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-host rate limits, so that looking books up in parallel doesn't DoS anyone.
+
+Each host gets its own token bucket. Hosts are matched by domain suffix, so every
+library's Overdrive subdomain is limited separately but with the same settings.
+"""
+
+import threading
+import time
+import urllib.parse
+
+
+# Requests per second, and how many can be made at once after a quiet spell.
+HOST_RATES = {
+  "find.minlib.net": (1.0, 2),
+  "overdrive.com": (1.0, 2),
+  "openlibrary.org": (2.0, 2),
+  "www.gutenberg.org": (1.0, 1),
+}
+DEFAULT_RATE = (2.0, 2)
+
+buckets = {}
+buckets_lock = threading.Lock()
+
+
+class TokenBucket:
+  """Allow rate requests per second on average, and up to burst at once."""
+
+  def __init__(self, rate, burst):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    """Take a token, sleeping until it would have been added to the bucket.
+
+    Tokens can go negative, which reserves a place in line for each waiting thread."""
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+      self.tokens -= 1
+      delay = -self.tokens / self.rate
+    if delay > 0:
+      time.sleep(delay)
+
+
+def host_rate(host):
+  """Find the limit for the most specific domain that host is part of."""
+  for domain in sorted(HOST_RATES, key=len, reverse=True):
+    if host == domain or host.endswith("." + domain):
+      return HOST_RATES[domain]
+  return DEFAULT_RATE
+
+
+def set_rate(domain, rate, burst=None):
+  """Change the limit for a domain, for any hosts that haven't been used yet."""
+  HOST_RATES[domain] = (rate, burst or host_rate(domain)[1])
+
+
+def wait(url):
+  """Block until a request to the host of url is allowed."""
+  host = urllib.parse.urlsplit(url).hostname or ""
+  with buckets_lock:
+    if host not in buckets:
+      buckets[host] = TokenBucket(*host_rate(host))
+    bucket = buckets[host]
+  bucket.acquire()
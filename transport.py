@@ -0,0 +1,171 @@
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""All the HTTP requests to book providers go through here.
+
+Each host gets one pooled session, so connections are kept alive between books instead
+of paying for a new TLS handshake every time. Every request has a timeout and is rate
+limited by throttle.py. Connection failures, timeouts and overloaded servers are
+retried a couple of times with jittered backoff.
+
+If a host keeps failing anyway, its circuit breaker opens and requests to it stop,
+instead of waiting out the timeouts again for every remaining book. After BREAKER_OPEN_FOR
+seconds one request is let through to see whether the host is back.
+"""
+
+import random
+import requests
+import requests.adapters
+import stats
+import threading
+import throttle
+import time
+import urllib.parse
+
+
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+RETRIES = 2
+BACKOFF = 1.0
+MAX_BACKOFF = 30
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# How many requests in a row can fail before a host is given up on. This is two books'
+# worth of retries.
+BREAKER_THRESHOLD = 2 * (RETRIES + 1)
+BREAKER_OPEN_FOR = 60
+POOL_SIZE = 8
+
+sessions = {}
+breakers = {}
+lock = threading.Lock()
+
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+  """Raised instead of making a request to a host that has been given up on."""
+
+
+class Breaker:
+  """Count consecutive failures for a host, and trip after too many.
+
+  An open breaker turns requests away for open_for seconds, and then lets one through.
+  If it succeeds the breaker closes, and if it fails it stays open for another
+  open_for."""
+
+  def __init__(self, threshold, open_for=BREAKER_OPEN_FOR):
+    self.threshold = threshold
+    self.open_for = open_for
+    self.failures = 0
+    self.opened = None
+    self.lock = threading.Lock()
+
+  def allow(self):
+    """Whether a request can be made now."""
+    with self.lock:
+      if self.opened is None:
+        return True
+      now = time.monotonic()
+      if now - self.opened < self.open_for:
+        return False
+      # This is the trial request. Others wait for another open_for, unless it succeeds.
+      self.opened = now
+      return True
+
+  def succeeded(self):
+    with self.lock:
+      self.failures = 0
+      self.opened = None
+
+  def failed(self):
+    with self.lock:
+      self.failures += 1
+      if self.failures >= self.threshold:
+        self.opened = time.monotonic()
+
+
+def host_state(host):
+  with lock:
+    if host not in sessions:
+      session = requests.Session()
+      adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+      session.mount("http://", adapter)
+      session.mount("https://", adapter)
+      sessions[host] = session
+    if host not in breakers:
+      breakers[host] = Breaker(BREAKER_THRESHOLD, BREAKER_OPEN_FOR)
+    return sessions[host], breakers[host]
+
+
+def close_breakers():
+  """Give every host a fresh start, forgetting its failures."""
+  with lock:
+    breakers.clear()
+
+
+def backoff(attempt, response=None):
+  """How long to wait before trying again, honoring Retry-After if it's given in seconds."""
+  if response is not None:
+    retry_after = response.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+      return min(int(retry_after), MAX_BACKOFF)
+  return min(BACKOFF * 2 ** attempt, MAX_BACKOFF) * random.uniform(0.5, 1.5)
+
+
+def count_on_close(host, r):
+  """Count the bytes read from a streamed response, however much of it that was."""
+  close = r.close
+  def counted_close():
+    if r.close is counted_close:
+      stats.received(host, r.raw.tell())
+      r.close = close
+    close()
+  r.close = counted_close
+
+
+def get(url, **kwargs):
+  """Like requests.get, with pooling, timeouts, retries and the host's circuit breaker.
+
+  Raises CircuitOpen without making a request once the host has failed too often."""
+  host = urllib.parse.urlsplit(url).hostname or ""
+  session, breaker = host_state(host)
+  kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+  attempt = 0
+  while True:
+    if not breaker.allow():
+      raise CircuitOpen("Giving up on {} after {} failures in a row".format(host, breaker.failures))
+    throttle.wait(url)
+    start = time.perf_counter()
+    try:
+      r = session.get(url, **kwargs)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+      stats.request(host, None, time.perf_counter() - start)
+      breaker.failed()
+      if attempt >= RETRIES:
+        raise
+      time.sleep(backoff(attempt))
+    else:
+      if kwargs.get("stream"):
+        stats.request(host, r.status_code, time.perf_counter() - start)
+        count_on_close(host, r)
+      else:
+        stats.request(host, r.status_code, time.perf_counter() - start, len(r.content))
+      if r.status_code not in RETRY_STATUSES:
+        breaker.succeeded()
+        return r
+      breaker.failed()
+      if attempt >= RETRIES:
+        return r
+      r.close()
+      time.sleep(backoff(attempt, r))
+    attempt += 1
@@ -0,0 +1,42 @@
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Small helpers shared by the scripts and the CGI pages.
+
+It only uses the standard library, so anything can import it cheaply.
+"""
+
+import os
+
+
+def write_atomically(path, write, binary=False):
+  """Call write with a file that replaces path only once it has been written, so a
+  reader never sees half of it."""
+  tmp = "{}.{}.tmp".format(path, os.getpid())
+  try:
+    with (open(tmp, "wb") if binary else open(tmp, "w", newline="")) as f:
+      write(f)
+  except:
+    os.remove(tmp)
+    raise
+  os.replace(tmp, path)
+
+
+def parse_rate(value):
+  """Read a --rate DOMAIN=RATE argument as (domain, requests per second)."""
+  domain, equals, per_second = value.partition("=")
+  if not domain or not equals:
+    raise ValueError("Expected DOMAIN=RATE, not {!r}".format(value))
+  return domain, float(per_second)
@@ -0,0 +1 @@
+../catalog.py
\ No newline at end of file
@@ -0,0 +1 @@
+../daemon.py
\ No newline at end of file
@@ -14,12 +14,73 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import cgi, cgitb
+import cgitb
 cgitb.enable()
 
+import os
+import sys
+
+from values import DAILY, DAILY_PAGE
+
+# Compressed copies render.py may have written, in order of preference.
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def accepted_encodings():
+  """The content codings the browser accepts, without any it has refused with q=0."""
+  accepted = set()
+  for item in os.environ.get("HTTP_ACCEPT_ENCODING", "").split(","):
+    coding, _, quality = item.partition(";")
+    quality = quality.replace(" ", "")
+    if quality.startswith("q="):
+      try:
+        if float(quality[2:]) == 0:
+          continue
+      except ValueError:
+        continue
+    accepted.add(coding.strip().lower())
+  return accepted
+
+
+def rendered():
+  """Whether render.py has rendered the page since the daily list was last written."""
+  try:
+    return os.path.getmtime(DAILY_PAGE + ".etag") >= os.path.getmtime(DAILY)
+  except OSError:
+    return False
+
 
 def main():
-  print("Location: find.cgi?daily=1\n")
+  """Send the pre-rendered daily page, or a 304 if the browser has it already.
+
+  If it hasn't been rendered yet, find.cgi renders the list instead."""
+  if not rendered():
+    print("Location: find.cgi?daily=1\n")
+    return
+  with open(DAILY_PAGE + ".etag") as f:
+    etag = f.read().strip()
+  headers = ["ETag: " + etag,
+             "Cache-Control: no-cache",
+             "Vary: Accept-Encoding"]
+  if etag in (tag.strip() for tag in os.environ.get("HTTP_IF_NONE_MATCH", "").split(",")):
+    print("Status: 304 Not Modified")
+    print("\n".join(headers) + "\n", flush=True)
+    return
+
+  path = DAILY_PAGE
+  accepted = accepted_encodings()
+  for coding, suffix in ENCODINGS:
+    if coding in accepted and os.path.exists(DAILY_PAGE + suffix):
+      path = DAILY_PAGE + suffix
+      headers.append("Content-Encoding: " + coding)
+      break
+  with open(path, "rb") as f:
+    body = f.read()
+  headers += ["Content-Type: text/html; charset=utf-8",
+              "Content-Length: {}".format(len(body))]
+  print("\n".join(headers) + "\n", flush=True)
+  sys.stdout.buffer.write(body)
+  sys.stdout.buffer.flush()
 
 
 if __name__ == "__main__":
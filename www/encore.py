@@ -0,0 +1 @@
+../encore.py
\ No newline at end of file
@@ -18,14 +18,18 @@ import cgi, cgitb
 cgitb.enable()
 
 import csv
+import daemon
 import json
 import io
-import library
-import os
+import jobs
+import render
+import shelves
 
-from values import DB
+from hidden_books import HiddenBooks
+from values import DAILY
 
-def lookup_books(books, csvfile, overdrive):
+def read_books(books, csvfile):
+  """Return (title, author) pairs for the uploaded CSV, then the text box."""
   if csvfile is not None and csvfile.filename:
     # In Python 2, I could have just said csv.DictReader(csvfile.file)
     # But because Python 3 has the wrong idea about unicode, I have to
@@ -39,9 +43,9 @@ def lookup_books(books, csvfile, overdrive):
       reader = csv.DictReader(lines)
     else:
       reader = csv.reader(lines)
-  items = []
+  pairs = []
   for row in reader:
-    if library.wrong_shelf(row):
+    if shelves.wrong_shelf(row):
       continue
     if "Title" in row:
       title = row["Title"]
@@ -53,125 +57,167 @@ def lookup_books(books, csvfile, overdrive):
       author = row[1]
     if not title.strip():
       continue
-    book = library.find_book(title, author, overdrive)
-    if library.found_book(book):
-      items.append(book)
+    pairs.append((title, author))
   if csvfile is not None and csvfile.filename:
-    items += lookup_books(books, None, overdrive)
-  return items
+    pairs += read_books(books, None)
+  return pairs
 
 
-def a_tag(url, text):
-  return "<a href='{}'>{}</a>".format(url, text)
+def iter_books(books, csvfile, overdrive, limit=None):
+  """Yield the books from the form that are available, as soon as each is looked up.
 
-def assemble_overdrive(book):
-  if "overdrive_url" in book:
-    return a_tag(book.get("overdrive_url"), book.get("overdrive", "ERROR"))
-  return book.get("overdrive", "")
+  With a limit, books on the daily list are looked up first, and looking stops once
+  that many are available.
 
+  The lookups are done by daemon.py if it's running, and otherwise here, which means
+  importing library and everything it needs first."""
+  pairs = read_books(books, csvfile)
+  try:
+    yield from daemon.iter_available(pairs, overdrive, limit, DAILY if limit else None)
+    return
+  except daemon.NotRunning:
+    pass
 
-def assemble_hoopla(book):
-  if "hoopla" in book:
-    if book["hoopla"].startswith("http"):
-      return a_tag(book["hoopla"], "True")
-  return book.get("hoopla", "")
+  import library
+  if limit:
+    pairs = library.prioritize(pairs, library.recently_available(DAILY))
+  yield from library.iter_available(pairs, overdrive or library.OVERDRIVE_SUBDOMAINS,
+                                    limit=limit)
 
 
-def assemble_other(book):
-  if "gutenberg" in book:
-    return a_tag("https://www.gutenberg.org/ebooks/{}".format(book["gutenberg"][2]), "gutenberg")
-  if "openlibrary" in book:
-    return "openlibrary"
-  return ""
+def lookup_books(books, csvfile, overdrive, limit=None):
+  return list(iter_books(books, csvfile, overdrive, limit))
 
 
-def assemble_book(book):
-  return {"title": book.get("title", ""),
-          "author": book.get("author", ""),
-          "overdrive": assemble_overdrive(book),
-          "hoopla": assemble_hoopla(book),
-          "other": assemble_other(book)}
+def overdrive_subdomains(overdrive):
+  """The subdomains asked for, or None for library.OVERDRIVE_SUBDOMAINS."""
+  if overdrive:
+    return overdrive.split(",")
+  return None
 
 
-def make_row(book):
-  return """<tr>
-  <td class="hide"><span>X</span></td>
-  <td class="title">{title}</td>
-  <td class="author">{author}</td>
-  <td class="overdrive">{overdrive}</td>
-  <td class="hoopla">{hoopla}</td>
-  <td class="other">{other}</td>
-</tr>""".format(title=book["title"],
-                author=book["author"],
-                overdrive=book["overdrive"],
-                hoopla=book["hoopla"],
-                other=book["other"])
+def stream(books, csvfile, overdrive, limit=None):
+  """Send one line of JSON per available book as soon as it is found.
 
+  script.js reads these and adds each row to the results table. The last line says
+  how many books were found and hidden."""
+  print("Content-Type: application/x-ndjson\n", flush=True)
 
-def page(books, csvfile, overdrive, daily=False):
-  print("Content-Type: text/html\n")
+  hidden = HiddenBooks()
+  count = 0
+  hidden_count = 0
+  for book in iter_books(books, csvfile, overdrive_subdomains(overdrive), limit):
+    assembled = render.assemble_book(book)
+    if hidden.contains(assembled["title"], assembled["author"]):
+      hidden_count += 1
+      continue
+    count += 1
+    print(json.dumps({"book": assembled, "row": render.make_row(assembled)}), flush=True)
+  print(json.dumps({"done": True, "count": count, "hidden": hidden_count}), flush=True)
 
-  if overdrive:
-    overdrive = overdrive.split(",")
-  else:
-    overdrive = library.OVERDRIVE_SUBDOMAINS
 
-  errors = ""
+def submit_job(books, csvfile, overdrive, redirect, limit=None):
+  """Start looking the books up in the background, and say where to find the results.
 
-  if daily:
-    with open(books) as f:
-      try:
-        book_data = json.load(f)
-      except json.decoder.JSONDecodeError as e:
-        if os.path.getsize(f.name) == 0:
-          errors = "Available books file empty."
-        else:
-          errors = str(e)
-        book_data = []
+  script.js asks for the job ID as JSON and polls for rows itself, and a plain form
+  submission is sent to the results page for the job."""
+  try:
+    job_id = jobs.submit(read_books(books, csvfile), overdrive_subdomains(overdrive),
+                         limit, DAILY if limit else None)
+  except jobs.Busy as e:
+    if redirect:
+      print("Content-Type: text/html\n")
+      print(render.page([], str(e)))
+    else:
+      print("Content-Type: application/json\n")
+      print(json.dumps({"error": str(e)}))
+    return
+  if redirect:
+    print("Location: find.cgi?job={}\n".format(job_id))
   else:
-    book_data = lookup_books(books, csvfile, overdrive)
+    print("Content-Type: application/json\n")
+    print(json.dumps({"job": job_id}))
 
-  db = {}
+
+def poll_job(job_id, since):
+  """Report a background job's progress, with the rows found after the first since.
+
+  since counts every book the job has found, hidden or not, so hiding one between
+  polls doesn't move the rest. "next" is the since for the next poll."""
+  print("Content-Type: application/json\n")
   try:
-    if os.path.exists(DB):
-      with open(DB) as f:
-        db = json.load(f)
-  except:
-    raise
-
-  embedded = []
-  rows = []
+    status = jobs.status(job_id)
+  except jobs.NoSuchJob:
+    print(json.dumps({"error": "No such job."}))
+    return
+
+  hidden = HiddenBooks()
+  results = []
   hidden_count = 0
-  for book in book_data:
-    assembled = assemble_book(book)
-    hidden_book = False
-    for hidden in db:
-      if hidden["title"] == assembled["title"] and hidden["author"] == assembled["author"]:
-        hidden_count += 1
-        hidden_book = True
-        break
-    if hidden_book:
-      continue
-    embedded.append(assembled)
-    rows.append(make_row(assembled))
-  count = len(rows)
-  rows = "\n".join(rows)
+  for n, book in enumerate(status["books"]):
+    assembled = render.assemble_book(book)
+    if hidden.contains(assembled["title"], assembled["author"]):
+      hidden_count += 1
+    elif n >= since:
+      results.append({"book": assembled, "row": render.make_row(assembled)})
+  print(json.dumps({"state": status["state"],
+                    "error": status.get("error"),
+                    "done": status["done"],
+                    "total": status["total"],
+                    "hidden": hidden_count,
+                    "results": results,
+                    "next": len(status["books"])}))
+
+
+def page(books, csvfile, overdrive, daily=False, job=None, limit=None):
+  print("Content-Type: text/html\n")
+
+  overdrive = overdrive_subdomains(overdrive)
+
+  errors = ""
+
+  if daily:
+    book_data, errors = render.read_daily(books)
+  elif job:
+    try:
+      status = jobs.status(job)
+      book_data = status["books"]
+      if status["state"] == "error":
+        errors = "Stopped after {} of {} books: {}".format(status["done"], status["total"],
+                                                           status.get("error"))
+      elif status["state"] != "done":
+        errors = "Still looking: {} of {} books checked so far. Reload for more.".format(
+          status["done"], status["total"])
+    except jobs.NoSuchJob:
+      errors = "No such job."
+      book_data = []
+  else:
+    book_data = lookup_books(books, csvfile, overdrive, limit)
 
-  with open("books.template.html") as f:
-    print(f.read().format(count=count,
-                          rows=rows,
-                          books_json=json.dumps(embedded),
-                          hidden=hidden_count,
-                          errors=errors))
+  print(render.page(book_data, errors, daily=daily))
 
 
 def main():
   params = cgi.FieldStorage()
   csvfile = params["csvfile"] if "csvfile" in params else None
   books = params.getfirst("books", "")
+  job = params.getfirst("job")
+  limit = params.getfirst("limit", "")
+  limit = int(limit) if limit.isdigit() and int(limit) > 0 else None
+  if params.getfirst("format") == "ndjson":
+    stream(books, csvfile, params.getfirst("overdrive"), limit)
+    return
+  if params.getfirst("format") == "job" or params.getfirst("background"):
+    submit_job(books, csvfile, params.getfirst("overdrive"),
+               redirect=params.getfirst("format") != "job", limit=limit)
+    return
+  if job and params.getfirst("format") == "json":
+    since = params.getfirst("since", "")
+    poll_job(job, int(since) if since.isdigit() else 0)
+    return
   if params.getfirst("daily"):
-    books = "available_books.json" # Set to filename for daily dump from ../cron.sh
-  page(books, None, params.getfirst("overdrive"), params.getfirst("daily"))
+    books = DAILY
+  page(books, None, params.getfirst("overdrive"), params.getfirst("daily"), job, limit)
 
 
 if __name__ == "__main__":
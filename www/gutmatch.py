@@ -0,0 +1 @@
+../gutmatch.py
\ No newline at end of file
@@ -0,0 +1,143 @@
+#! /usr/bin/env python3
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The books that have been hidden from the daily list.
+
+They are kept in an append-only log with one JSON object per line, so hiding a book is
+one small write instead of rewriting the whole list. Writers take an exclusive lock on
+a separate lock file, so two quick clicks can't lose a book, and readers take a shared
+one. Books are matched on their normalized title and author, with a set lookup.
+
+The first time the log is opened, books from the old hidden_books.json are copied into
+it. If that file can't be read, it is left alone and nothing is copied: the list reads
+as empty, and hiding a book fails, until it is fixed or moved away. Hiding the same
+book twice adds a duplicate line, which compaction removes.
+
+Usage: hidden_books.py compact
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import sys
+import util
+
+from values import DB, HIDDEN_LOG
+
+
+class LegacyListError(Exception):
+  pass
+
+
+def book_key(title, author):
+  """Ignore case and spacing differences when matching books."""
+  return (" ".join((title or "").split()).casefold(),
+          " ".join((author or "").split()).casefold())
+
+
+class HiddenBooks:
+
+  def __init__(self, path=HIDDEN_LOG, legacy_path=DB):
+    self.path = path
+    self.legacy_path = legacy_path
+    self.keys = set()
+    with self.locked(fcntl.LOCK_EX if self.needs_migration() else fcntl.LOCK_SH):
+      if self.needs_migration():
+        try:
+          self.migrate()
+        except LegacyListError as e:
+          sys.stderr.write("{}\n".format(e))
+      for book in self.read():
+        self.keys.add(book_key(book["title"], book["author"]))
+
+  @contextlib.contextmanager
+  def locked(self, operation):
+    with open(self.path + ".lock", "a") as lock:
+      fcntl.flock(lock, operation)
+      try:
+        yield
+      finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+
+  def read(self):
+    if not os.path.exists(self.path):
+      return []
+    books = []
+    with open(self.path) as f:
+      for line in f:
+        if line.strip():
+          books.append(json.loads(line))
+    return books
+
+  def needs_migration(self):
+    return not os.path.exists(self.path) and os.path.exists(self.legacy_path)
+
+  def migrate(self):
+    """Copy the books from the old JSON list. The caller holds the exclusive lock.
+
+    Raises LegacyListError, without writing the log, if the list can't be read."""
+    with open(self.legacy_path) as f:
+      try:
+        books = json.load(f)
+      except json.decoder.JSONDecodeError as e:
+        raise LegacyListError("{} couldn't be read, so it hasn't been copied to {}: {}".format(
+          self.legacy_path, self.path, e))
+    self.write(books)
+
+  def write(self, books):
+    def write_lines(f):
+      for book in books:
+        f.write(json.dumps({"title": book["title"], "author": book["author"]}) + "\n")
+    util.write_atomically(self.path, write_lines)
+
+  def contains(self, title, author):
+    return book_key(title, author) in self.keys
+
+  def add(self, title, author):
+    with self.locked(fcntl.LOCK_EX):
+      # Starting the log now would leave the old list's books out of it for good.
+      if self.needs_migration():
+        self.migrate()
+      with open(self.path, "a") as f:
+        f.write(json.dumps({"title": title, "author": author}) + "\n")
+    self.keys.add(book_key(title, author))
+
+  def compact(self):
+    """Rewrite the log without duplicates, returning how many lines were dropped."""
+    with self.locked(fcntl.LOCK_EX):
+      books = self.read()
+      seen = set()
+      unique = []
+      for book in books:
+        key = book_key(book["title"], book["author"])
+        if key not in seen:
+          seen.add(key)
+          unique.append(book)
+      self.write(unique)
+    self.keys = seen
+    return len(books) - len(unique)
+
+
+def main(argv):
+  if len(argv) != 2 or argv[1] != "compact":
+    print(__doc__.strip().split("\n")[-1])
+    exit(1)
+  print("{} duplicates removed".format(HiddenBooks().compact()))
+
+
+if __name__ == "__main__":
+  main(sys.argv)
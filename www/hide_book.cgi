@@ -17,27 +17,29 @@
 import cgi, cgitb
 cgitb.enable()
 
-import csv
-from datetime import date
 import json
 import os
-import shutil
+import render
 import sys
 
-from values import DB
+from hidden_books import HiddenBooks, LegacyListError
+from values import DAILY
 
 def hide_book(title, author):
-  db = []
-  if os.path.exists(DB):
-    try:
-      with open(DB) as f:
-        db = json.load(f)
-    except json.decoder.JSONDecoderError:
-      shutil.copy(DB, "{}-{}".format(DB, date.isoformat()))
-  db.append({"title": title,
-             "author": author})
-  with open(DB, "w") as f:
-    json.dump(db, f)
+  try:
+    HiddenBooks().add(title, author)
+  except LegacyListError as e:
+    print(json.dumps({"result": "error",
+                      "error": type(e).__name__,
+                      "value": str(e)}))
+    return
+  # The book is hidden either way, so a failure here only leaves daily.cgi showing it
+  # until the next render.
+  try:
+    if os.path.exists(DAILY):
+      render.render_daily()
+  except Exception as e:
+    sys.stderr.write("Not rendering the daily page: {}\n".format(e))
   print(json.dumps({"result": "success"}))
 
 
@@ -0,0 +1 @@
+../jobs.py
\ No newline at end of file
@@ -0,0 +1 @@
+../mediaitems.py
\ No newline at end of file
@@ -0,0 +1 @@
+../olindex.py
\ No newline at end of file
@@ -0,0 +1,166 @@
+#! /usr/bin/env python3
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The results page, as rows of available books in books.template.html.
+
+find.cgi renders a search's results when it finishes. The daily list only changes when
+cron.sh writes a new one or a book is hidden, so it is rendered then instead, into
+DAILY_PAGE, with gzip and, if the brotli module is installed, brotli copies next to it.
+The ETag file holds a hash of the page, for daily.cgi to answer If-None-Match with.
+
+Usage: render.py
+"""
+
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import importlib.util
+import json
+import os
+import sys
+import util
+
+from hidden_books import HiddenBooks
+from values import DAILY, DAILY_PAGE
+
+if importlib.util.find_spec("brotli"):
+  import brotli
+else:
+  brotli = None
+
+TEMPLATE = "books.template.html"
+
+
+def a_tag(url, text):
+  return "<a href='{}'>{}</a>".format(url, text)
+
+def assemble_overdrive(book):
+  if "overdrive_url" in book:
+    return a_tag(book.get("overdrive_url"), book.get("overdrive", "ERROR"))
+  return book.get("overdrive", "")
+
+
+def assemble_hoopla(book):
+  if "hoopla" in book:
+    # Without a link, Minuteman only said the book is on Hoopla, and this is True.
+    if str(book["hoopla"]).startswith("http"):
+      return a_tag(book["hoopla"], "True")
+  return book.get("hoopla", "")
+
+
+def assemble_other(book):
+  if "gutenberg" in book:
+    return a_tag("https://www.gutenberg.org/ebooks/{}".format(book["gutenberg"][2]), "gutenberg")
+  if "openlibrary" in book:
+    return "openlibrary"
+  return ""
+
+
+def assemble_book(book):
+  return {"title": book.get("title", ""),
+          "author": book.get("author", ""),
+          "overdrive": assemble_overdrive(book),
+          "hoopla": assemble_hoopla(book),
+          "other": assemble_other(book)}
+
+
+def make_row(book):
+  return """<tr>
+  <td class="hide"><span>X</span></td>
+  <td class="title">{title}</td>
+  <td class="author">{author}</td>
+  <td class="overdrive">{overdrive}</td>
+  <td class="hoopla">{hoopla}</td>
+  <td class="other">{other}</td>
+</tr>""".format(title=book["title"],
+                author=book["author"],
+                overdrive=book["overdrive"],
+                hoopla=book["hoopla"],
+                other=book["other"])
+
+
+def read_daily(path=DAILY):
+  """Return the books on the daily list, and an error message if it couldn't be read."""
+  with open(path) as f:
+    try:
+      return json.load(f), ""
+    except json.decoder.JSONDecodeError as e:
+      if os.path.getsize(f.name) == 0:
+        return [], "Available books file empty."
+      return [], str(e)
+
+
+def page(book_data, errors="", hidden=None, daily=False):
+  """Return the results page for these books, leaving out the hidden ones."""
+  hidden = hidden or HiddenBooks()
+
+  embedded = []
+  rows = []
+  hidden_count = 0
+  for book in book_data:
+    assembled = assemble_book(book)
+    if hidden.contains(assembled["title"], assembled["author"]):
+      hidden_count += 1
+      continue
+    embedded.append(assembled)
+    rows.append(make_row(assembled))
+  count = len(rows)
+  rows = "\n".join(rows)
+
+  with open(TEMPLATE) as f:
+    return f.read().format(count=count,
+                           rows=rows,
+                           books_json=json.dumps(embedded),
+                           daily=json.dumps(bool(daily)),
+                           hidden=hidden_count,
+                           errors=errors)
+
+
+def write_file(path, data):
+  util.write_atomically(path, lambda f: f.write(data), binary=True)
+
+
+def render_daily(path=DAILY, output=DAILY_PAGE):
+  """Write the daily page and its compressed copies, and then its ETag.
+
+  Renders are one at a time, and each reads the hidden books once it has its turn, so
+  the last one always includes every book hidden before it."""
+  with open(output + ".lock", "a") as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    books, errors = read_daily(path)
+    html = page(books, errors, HiddenBooks(), daily=True).encode("utf8")
+    write_file(output, html)
+    write_file(output + ".gz", gzip.compress(html, 9, mtime=0))
+    if brotli:
+      write_file(output + ".br", brotli.compress(html))
+    else:
+      # A copy from when brotli was installed would be out of date.
+      with contextlib.suppress(FileNotFoundError):
+        os.remove(output + ".br")
+    etag = '"{}"'.format(hashlib.sha256(html).hexdigest()[:20])
+    write_file(output + ".etag", etag.encode() + b"\n")
+
+
+def main(argv):
+  if len(argv) != 1:
+    print(__doc__.strip().split("\n")[-1])
+    exit(1)
+  render_daily()
+
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1 @@
+../scheduler.py
\ No newline at end of file
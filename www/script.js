@@ -17,14 +17,139 @@ function example_data() {
   books.value = document.getElementById("example").textContent;
 }
 
+// Books added to the search page as they stream in from find.cgi.
+const streamed_books = [];
+
 function download_books() {
+  const books = (typeof books_json == "undefined") ? streamed_books : books_json;
   download_csv_file(["title", "author", "overdrive", "hoopla", "other"],
-    books_json, "table.csv");
+    books, "table.csv");
+}
+
+function add_result(result) {
+  if (result.done) {
+    document.getElementById("count").textContent = result.count;
+    document.getElementById("hidden").textContent = result.hidden;
+    document.getElementById("searching").hidden = true;
+    return;
+  }
+  const rows = document.getElementById("result_rows");
+  rows.insertAdjacentHTML("beforeend", result.row);
+  book_events(rows.lastElementChild);
+  streamed_books.push(result.book);
+  document.getElementById("count").textContent = streamed_books.length;
+}
+
+function show_results() {
+  streamed_books.length = 0;
+  document.getElementById("result_rows").textContent = "";
+  document.getElementById("count").textContent = 0;
+  document.getElementById("progress").textContent = "";
+  document.getElementById("searching").hidden = false;
+  document.getElementById("errors").textContent = "";
+  const results = document.getElementById("results");
+  results.hidden = false;
+  results.scrollIntoView();
+}
+
+function show_error(error) {
+  const line = document.createElement("div");
+  line.textContent = error.message;
+  document.getElementById("errors").appendChild(line);
+  document.getElementById("searching").hidden = true;
+}
+
+// Check on a background job every few seconds, adding the rows found since last time.
+async function poll_job(job_id) {
+  let since = 0;
+  let shown = 0;
+  while (true) {
+    const response = await fetch(`find.cgi?job=${job_id}&format=json&since=${since}`);
+    if (response.status != 200) {
+      throw new Error(`Checking on the search failed: ${response.status}.`);
+    }
+    const job = await response.json();
+    if (job.results) {
+      job.results.map(add_result);
+      shown += job.results.length;
+      since = job.next;
+    }
+    if (job.error) {
+      throw new Error(job.error);
+    }
+    document.getElementById("progress").textContent = `(${job.done} of ${job.total} checked)`;
+    if (job.state == "done") {
+      add_result({done: true, count: shown, hidden: job.hidden});
+      return;
+    }
+    await new Promise(resolve => setTimeout(resolve, 2000));
+  }
+}
+
+// Hand a long list to a background job on the server, and poll it for results.
+// The job ID goes in the address, so reloading the page picks the results up again.
+async function run_job(data) {
+  data.append("format", "job");
+  const response = await fetch("find.cgi", {method: "POST", body: data});
+  if (response.status != 200) {
+    throw new Error(`Search failed: ${response.status}.`);
+  }
+  const job = await response.json();
+  if (job.error) {
+    throw new Error(job.error);
+  }
+  history.replaceState(null, "", `?job=${job.job}`);
+  await poll_job(job.job);
+}
+
+// Submit the search form, and add each book to the page as soon as find.cgi finds it,
+// instead of waiting for the whole list to load a new page.
+async function stream_results(e) {
+  if (!window.ReadableStream || !window.TextDecoderStream) {
+    return; // Let the form load the results page the old way.
+  }
+  e.preventDefault();
+  const data = new FormData(e.target);
+  show_results();
+
+  if (data.get("background")) {
+    data.delete("background");
+    run_job(data).catch(show_error);
+    return;
+  }
+  data.append("format", "ndjson");
+
+  try {
+    const response = await fetch("find.cgi", {method: "POST", body: data});
+    if (response.status != 200) {
+      throw new Error(`Search failed: ${response.status}.`);
+    }
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = "";
+    while (true) {
+      const {value, done} = await reader.read();
+      if (done) {
+        break;
+      }
+      buffer += value;
+      const lines = buffer.split("\n");
+      buffer = lines.pop();
+      for (let line of lines) {
+        if (line.trim()) {
+          add_result(JSON.parse(line));
+        }
+      }
+    }
+  } catch (error) {
+    show_error(error);
+  }
 }
 
 async function record_hide_book(tr) {
   const params = new URLSearchParams(location.search);
-  if (params.get("daily") != "1") {
+  // The pre-rendered daily page is served without ?daily=1, and says so itself.
+  const daily = params.get("daily") == "1" || (typeof daily_list != "undefined" && daily_list);
+  if (!daily) {
     return false;
   }
 
@@ -71,6 +196,15 @@ function init() {
     }
 
     Array.from(document.querySelectorAll("tr")).map(book_events);
+
+    const form = document.getElementById("search");
+    if (form) {
+	form.addEventListener("submit", stream_results);
+	if (query_params.get("job")) {
+	    show_results();
+	    poll_job(query_params.get("job")).catch(show_error);
+	}
+    }
 }
 
 init();
@@ -0,0 +1 @@
+../shelves.py
\ No newline at end of file
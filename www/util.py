@@ -0,0 +1 @@
+../util.py
\ No newline at end of file
@@ -15,3 +15,8 @@
 # limitations under the License.
 
 DB = "hidden_books.json"
+HIDDEN_LOG = "hidden_books.ndjson"
+# The daily list of available books, written by ../cron.sh.
+DAILY = "available_books.json"
+# The daily list rendered ahead of time by render.py, which daily.cgi serves.
+DAILY_PAGE = "daily.html"